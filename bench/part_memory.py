@@ -0,0 +1,84 @@
+"""
+Measures the memory taken by the records of a node scan, to compare plain objects, the __slots__ FilePart and
+PartColumns. Each run builds n parts of one kind and prints the bytes they take:
+
+    python bench/part_memory.py dict 1000000
+    python bench/part_memory.py slots 1000000
+    python bench/part_memory.py cols 1000000
+
+By default the allocations are traced with tracemalloc, with "rss" after the count the growth in the process's max
+resident set size is measured instead, which is much quicker for 10M parts. Run each kind in its own process.
+"""
+import os
+import sys
+import gc
+import importlib
+import resource
+import tracemalloc
+
+# the modules only import as a package, which is named after the directory the repository is in
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(repo))
+master_controller = importlib.import_module(os.path.basename(repo) + ".master_controller")
+
+
+class DictPart:
+    # FilePart as it was before __slots__
+    def __init__(self):
+        self.id = -1
+        self.file_id = -1
+        self.node_id = -1
+        self.access_name = ""
+        self.sequence_order = -1
+        self.size = 0
+        self.status = None
+
+
+def rows(n):
+    # tbl_file_part rows of 8-part files spread over 40 nodes, with the usual access names
+    for i in range(n):
+        file_id = 100000 + i // 8
+        yield (i + 1, file_id, 1 + i % 40, str(file_id) + "_" + str(i % 8), i % 8, 1048576 + i, None)
+
+
+def build(kind, n):
+    if kind == "cols":
+        columns = master_controller.PartColumns()
+        for row in rows(n):
+            columns.append(row)
+        return columns
+
+    parts = []
+    for row in rows(n):
+        part = DictPart() if kind == "dict" else master_controller.FilePart()
+        part.id, part.file_id, part.node_id, part.access_name, part.sequence_order, part.size, part.status = row
+        parts.append(part)
+    return parts
+
+
+def main(args):
+    if len(args) < 3 or args[1] not in ("dict", "slots", "cols"):
+        print("usage: part_memory.py dict|slots|cols <parts> [rss]")
+        sys.exit()
+
+    kind = args[1]
+    n = int(args[2])
+    rss = "rss" in args[3:]
+
+    gc.collect()
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if not rss:
+        tracemalloc.start()
+
+    parts = build(kind, n)
+
+    if rss:
+        # ru_maxrss is in KiB on Linux
+        used = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base) * 1024
+    else:
+        used = tracemalloc.get_traced_memory()[0]
+    print("%s %d parts: %.0f MB (%.0f B/part)" % (kind, len(parts), used / 1e6, used / n))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
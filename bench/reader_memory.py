@@ -0,0 +1,85 @@
+"""
+Checks that streaming a file through Master.open_file only holds the ranges the FileReader is meant to: window
+ranges downloading ahead, the one being read, and the one the caller was handed last. Starts a master and a few
+slaves on this machine in a scratch directory, uploads a file of random bytes, reads it back with allocations
+traced by tracemalloc and exits with an error if the peak is over that bound:
+
+    python bench/reader_memory.py
+    python bench/reader_memory.py 256 asyncio
+
+The size of the file is in MB, and the engine is util.master_engine. The master's ports have to be free.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import importlib
+import subprocess
+import tracemalloc
+
+# the modules only import as a package, which is named after the directory the repository is in
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(repo))
+master_controller = importlib.import_module(os.path.basename(repo) + ".master_controller")
+util = importlib.import_module(os.path.basename(repo) + ".util")
+
+num_slaves = 3
+
+
+def start_slaves(scratch):
+    slaves = []
+    for i in range(num_slaves):
+        store = os.path.join(scratch, "slave" + str(i))
+        os.makedirs(store)
+        slaves.append(subprocess.Popen([sys.executable, os.path.join(repo, "slave_controller.py"), "localhost",
+                                        "15719", str(10 ** 10), store],
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+    return slaves
+
+
+def main(args):
+    size = int(args[1]) * 1048576 if len(args) > 1 else 128 * 1048576
+    if len(args) > 2:
+        util.master_engine = args[2]
+    # every range has to come from the slaves
+    util.part_cache_size = 0
+
+    scratch = tempfile.mkdtemp()
+    os.chdir(scratch)
+    slaves = start_slaves(scratch)
+    try:
+        master = master_controller.Master()
+        start = time.monotonic()
+        while len(master.nodes) < num_slaves:
+            if time.monotonic() - start > 30:
+                sys.exit("the slaves didn't connect")
+            time.sleep(util.wait_interval)
+
+        file_obj = master.upload_file("reader_memory", bytearray(os.urandom(size)))
+
+        tracemalloc.start()
+        read = 0
+        with master.open_file(file_obj.id) as reader:
+            for chunk in reader:
+                read += len(chunk)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        # the receive buffers of the connections are allowed for on top of the ranges
+        bound = (util.readahead_window + 2) * util.readahead_size + 8 * util.transfer_bufsize
+        print("%s: read %d MB, peak %.1f MB, bound %.1f MB" % (util.master_engine, read // 1048576, peak / 1e6,
+                                                             bound / 1e6))
+        if read != size:
+            sys.exit("read %d bytes of %d" % (read, size))
+        if peak > bound:
+            sys.exit("the reader held more than its window")
+
+    finally:
+        for slave in slaves:
+            slave.kill()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,60 @@
+import sqlite3
+import threading
+import contextlib
+if __name__ == "database":
+    # imported by master_controller.py being run as a script
+    import util
+else:
+    from . import util
+
+
+local = threading.local()
+
+
+def connect():
+    """
+    Returns this thread's connection to the metadata database, opening it the first time the thread asks. The
+    connection stays open for the life of the thread, so the model classes can get it for every query without the
+    cost of reopening the database, and its prepared statements are kept between calls. The database is put in WAL
+    mode so readers and the writer don't block each other. Statements run in autocommit mode, so a statement which
+    fails can't leave a transaction open on the thread's connection, and anything needing several statements to be
+    atomic has to begin its own transaction
+    :return:
+    """
+    conn = getattr(local, "conn", None)
+    if conn is None or local.path != util.database:
+        conn = sqlite3.connect(util.database, isolation_level=None,
+                               cached_statements=util.database_cached_statements)
+        conn.execute("PRAGMA journal_mode = WAL")
+        # with WAL a commit is still atomic and durable against the process crashing, only the last transactions
+        # can be lost to a power failure
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA cache_size = " + str(-util.database_cache_size))
+        conn.execute("PRAGMA mmap_size = " + str(util.database_mmap_size))
+        conn.execute("PRAGMA temp_store = MEMORY")
+
+        local.conn = conn
+        local.path = util.database
+
+    return conn
+
+
+@contextlib.contextmanager
+def transaction():
+    """
+    Runs the statements made on this thread's connection inside the with block as one transaction, which is rolled
+    back if the block raises. A transaction begun while another is open on the thread just becomes part of it
+    :return:
+    """
+    conn = connect()
+    if conn.in_transaction:
+        yield conn
+        return
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
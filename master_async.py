@@ -0,0 +1,446 @@
+import asyncio
+import socket
+import threading
+import time
+import itertools
+if __name__ == "master_async":
+    # imported by master_controller.py being run as a script
+    import util
+else:
+    from . import util
+
+
+class AsyncRequest:
+    def __init__(self, request_id, open_sink=None):
+        self.request_id = request_id
+        self.open_sink = open_sink  # called with the first response frame, returns where the payload is written
+        self.sink = None
+        self.frame = None
+        self.error = None
+        self.last_activity = time.monotonic()
+        self.done = asyncio.Event()
+
+
+class AsyncNodeConnection:
+    """
+    The asyncio counterpart of NodeConnection. Responses are matched to requests by request_id in the same way,
+    but they are read by a task on the engine's loop instead of a thread. Every method must be called from that
+    loop, which is also why nothing here needs a lock
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = {}  # key: request_id  value: AsyncRequest waiting on a response
+        self.request_ids = itertools.count(1)
+        self.closed = False
+        self.users = 0  # transfers which have this connection checked out
+
+        # don't let more than one frame's payload pile up in the transport before a sender waits
+        self.writer.transport.set_write_buffer_limits(high=util.transfer_bufsize)
+        self.read_task = asyncio.get_running_loop().create_task(self.read_loop())
+
+    @staticmethod
+    async def open(sock):
+        reader, writer = await asyncio.open_connection(sock=sock, limit=util.transfer_bufsize)
+
+        return AsyncNodeConnection(reader, writer)
+
+    def new_request(self, open_sink=None):
+        if self.closed:
+            raise socket.error("connection closed")
+        request = AsyncRequest(next(self.request_ids) & 0xFFFFFFFF, open_sink)
+        self.pending[request.request_id] = request
+
+        return request
+
+    def write_frame(self, opcode, request_id=0, meta=b"", payload=b"", status=util.status_ok, flags=0):
+        # the frame is handed to the transport in one go, so frames of different requests never get mixed
+        if self.closed:
+            raise socket.error("connection closed")
+        header = util.frame_header.pack(util.protocol_version, opcode, flags, status, request_id, len(meta),
+                                        len(payload))
+        self.writer.write(header + meta)
+        if len(payload) > 0:
+            self.writer.write(payload)
+
+    async def send_frame(self, opcode, request_id=0, meta=b"", payload=b"", status=util.status_ok, flags=0):
+        self.write_frame(opcode, request_id, meta, payload, status, flags)
+        await self.writer.drain()
+
+    async def send_message(self, opcode, request_id, meta, chunks):
+        """
+        Sends a message whose payload is made up of the given chunks, framed the same way as util.send_message.
+        If reading the chunks fails or the sender is cancelled, the message is ended with an aborted frame
+        :param opcode:
+        :param request_id:
+        :param meta:
+        :param chunks:
+        :return:
+        """
+        try:
+            await self.send_frame(opcode, request_id, meta, flags=util.flag_more)
+            chunks = iter(chunks)
+            while True:
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    break
+                except Exception as e:
+                    await self.send_frame(util.op_data, request_id, status=util.status_fail)
+                    raise util.TransferAborted("reading the message failed: " + str(e)) from e
+
+                view = memoryview(chunk)
+                for pos in range(0, len(view), util.transfer_bufsize):
+                    await self.send_frame(util.op_data, request_id, payload=view[pos:pos + util.transfer_bufsize],
+                                          flags=util.flag_more)
+            await self.send_frame(util.op_data, request_id)
+
+        except asyncio.CancelledError:
+            # let the slave throw away what it got so far
+            try:
+                self.write_frame(util.op_data, request_id, status=util.status_fail)
+            except socket.error:
+                pass
+            raise
+
+    async def get_response(self, request, timeout=util.slave_response_timeout):
+        """
+        Waits for the whole response to the given request and returns its first frame. The request fails if
+        nothing arrives for it within timeout seconds, and is cancelled if the caller is
+        :param request:
+        :param timeout:
+        :return:
+        """
+        request.last_activity = max(request.last_activity, time.monotonic())
+        try:
+            while not request.done.is_set():
+                try:
+                    await asyncio.wait_for(request.done.wait(), timeout)
+                except asyncio.TimeoutError:
+                    if self.timed_out(request, timeout):
+                        raise socket.error("response time out")
+        except (socket.error, asyncio.CancelledError):
+            self.cancel(request)
+            raise
+
+        if request.error is not None:
+            raise socket.error(request.error)
+
+        return request.frame
+
+    async def check_response(self, request, action, timeout=util.slave_response_timeout):
+        # like get_response, but failures reported by the slave are raised as errors
+        frame = await self.get_response(request, timeout)
+        if frame.status != util.status_ok:
+            raise socket.error(action + " failed: " + util.s_from_bytes(frame.meta))
+
+        return frame
+
+    def timed_out(self, request, timeout):
+        return not request.done.is_set() and time.monotonic() - request.last_activity >= timeout
+
+    def cancel(self, request):
+        """
+        Gives up on the given request. Anything still to come for it is thrown away, and the slave is told so it
+        can stop sending
+        :param request:
+        :return:
+        """
+        if self.pending.pop(request.request_id, None) is not None:
+            request.error = "request cancelled"
+            request.done.set()
+            try:
+                self.write_frame(util.op_cancel, request.request_id)
+            except socket.error:
+                pass
+
+    async def read_loop(self):
+        try:
+            while True:
+                frame, meta_len = util.unpack_frame_header(await self.reader.readexactly(util.frame_header.size))
+                frame.meta = await self.reader.readexactly(meta_len)
+
+                # if the request was given up on, whatever is still coming for it is thrown away
+                request = self.pending.get(frame.request_id)
+
+                if request is not None:
+                    request.last_activity = time.monotonic()
+                    if request.frame is None:
+                        request.frame = frame
+                        if frame.status == util.status_ok and request.open_sink is not None:
+                            try:
+                                request.sink = request.open_sink(frame)
+                            except Exception as e:
+                                request.error = str(e)
+                    elif frame.opcode != util.op_data:
+                        raise util.ProtocolError("expected the rest of response " + str(frame.request_id))
+                    elif frame.status != util.status_ok:
+                        request.error = "transfer aborted by the slave"
+
+                num_left = frame.payload_len
+                while num_left > 0:
+                    chunk = await self.reader.read(min(num_left, util.transfer_bufsize))
+                    if len(chunk) == 0:
+                        raise ConnectionError("connection closed with " + str(num_left) + " bytes left to receive")
+                    num_left -= len(chunk)
+                    if request is not None and request.sink is not None and request.error is None:
+                        try:
+                            request.sink.write(chunk)
+                        except Exception as e:
+                            request.error = str(e)
+
+                if request is not None and not frame.flags & util.flag_more:
+                    self.pending.pop(frame.request_id, None)
+                    request.done.set()
+
+        except (socket.error, EOFError, ValueError) as e:
+            self.fail_all("connection lost: " + str(e))
+
+    def fail_all(self, error):
+        self.closed = True
+        requests = list(self.pending.values())
+        self.pending.clear()
+
+        for request in requests:
+            request.error = error
+            request.done.set()
+
+    def close(self):
+        self.writer.close()
+        self.fail_all("connection closed")
+
+
+class AsyncEngine:
+    """
+    Runs the master's requests to the slaves as coroutines on a single event loop, so a file spread over hundreds
+    of nodes doesn't need a thread per part. The loop runs in its own thread and the master's threads hand it work
+    through run(). Only the data connections are given to the engine, the control connections and heartbeats stay
+    with the threaded NodeConnection. Streamed uploads (upload_sequential), repairs relayed through the master
+    (upload_copies and iter_part) and replicate_part also still check connections out of the threaded pools and run
+    on the master's workers. The reads of uploaded files and the writes of downloaded ones are done inline on the
+    loop, so a slow local disk holds up the other transfers
+    """
+    def __init__(self, stats):
+        self.pools = {}  # key: node  value: list of AsyncNodeConnection, only touched from the loop
+        self.stats = stats  # the master's NodeStats, which downloads are measured in and ranked by
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def run(self, coro, timeout=None):
+        """
+        Runs the coroutine on the engine's loop and waits for its result. If the caller stops waiting, whether from
+        the timeout or anything else, the coroutine is cancelled along with every request it has open
+        :param coro:
+        :param timeout:
+        :return:
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            future.cancel()
+            raise
+
+    def submit(self, coro):
+        # starts the coroutine on the engine's loop without waiting for it, returning a Future for its result
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def attach(self, node, sock):
+        self.run(self.add_connection(node, sock))
+
+    def detach(self, node):
+        self.run(self.close_connections(node))
+
+    async def add_connection(self, node, sock):
+        connection = await AsyncNodeConnection.open(sock)
+        if node not in self.pools:
+            self.pools[node] = []
+        self.pools[node].append(connection)
+
+    async def close_connections(self, node):
+        for connection in self.pools.pop(node, []):
+            connection.close()
+
+    def checkout(self, node):
+        # returns the node's data connection with the fewest transfers using it
+        connections = [x for x in self.pools.get(node, []) if not x.closed]
+        self.pools[node] = connections
+        if len(connections) == 0:
+            raise socket.error("no data connection to node " + str(node.id))
+        connection = min(connections, key=lambda var: var.users)
+        connection.users += 1
+
+        return connection
+
+    def checkin(self, connection):
+        connection.users -= 1
+
+    async def gather(self, coros):
+        """
+        Runs the coroutines at once and returns the result of each, or the message of the socket.error it raised
+        :param coros:
+        :return:
+        """
+        results = await asyncio.gather(*coros, return_exceptions=True)
+        for index, result in enumerate(results):
+            if isinstance(result, socket.error):
+                results[index] = str(result)
+            elif isinstance(result, BaseException):
+                raise result
+
+        return results
+
+    async def upload_part(self, node, name, chunks):
+        connection = self.checkout(node)
+        try:
+            # send the name and file part in one go
+            request = connection.new_request()
+            try:
+                await connection.send_message(util.op_upload, request.request_id, util.s_to_bytes(name), chunks)
+            except socket.error:
+                # this includes uploads aborted because reading the chunks failed, no need to wait for the answer
+                connection.cancel(request)
+                raise
+            await connection.check_response(request, "upload")
+        finally:
+            self.checkin(connection)
+
+    async def download_replicas_to(self, copies, writer, offset, length):
+        """
+        Downloads a part, or length bytes of it from offset, into writer from the first of its (part, node) copies,
+        asking the next copy as well if the first hasn't started answering after stats.hedge_delay(). The same as
+        Master.download_replicas_to
+        :param copies:
+        :param writer:
+        :param offset:
+        :param length:
+        :return:
+        """
+        race = util.DownloadRace(writer, asyncio.Event())
+        started = []  # [node, connection, request, start time] of each copy asked
+        live = []  # the ones of those which haven't failed
+        error = None
+        hedged = False
+        hedge_at = 0.0
+        try:
+            while race.winner is None:
+                now = time.monotonic()
+                for attempt in list(live):
+                    node, connection, request, start = attempt
+                    if race.winner is attempt:
+                        continue
+                    if request.done.is_set() or connection.timed_out(request, util.slave_response_timeout):
+                        # it failed without answering
+                        live.remove(attempt)
+                        if not request.done.is_set():
+                            self.stats.record_latency(node.id, now - start)
+                        connection.cancel(request)
+                        if request.error is not None:
+                            error = request.error
+                        elif request.frame is not None:
+                            error = "download failed: " + util.s_from_bytes(request.frame.meta)
+
+                if race.winner is not None:
+                    break
+                if len(live) == 0 or (len(live) == 1 and not hedged and now >= hedge_at):
+                    if len(started) == len(copies):
+                        if len(live) == 0:
+                            raise socket.error(error or "download time out")
+                    else:
+                        hedged = len(live) > 0
+                        part, node = copies[len(started)]
+                        self.stats.begin(node.id)
+                        attempt = [node, None, None, now]
+                        started.append(attempt)
+                        try:
+                            attempt[1] = self.checkout(node)
+                            attempt[2] = attempt[1].new_request(race.claimer(attempt))
+                            await attempt[1].send_frame(util.op_download, attempt[2].request_id,
+                                                        util.download_meta(part.access_name, offset, length))
+                            live.append(attempt)
+                            hedge_at = now + self.stats.hedge_delay()
+                        except socket.error as e:
+                            error = str(e)
+                            continue
+
+                wait = util.wait_interval
+                if not hedged and len(started) < len(copies):
+                    wait = max(0.0, min(wait, hedge_at - time.monotonic()))
+                try:
+                    await asyncio.wait_for(race.answered.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+
+            # the part is written out by the winner's reader as it arrives, the rest are stopped
+            node, connection, request, start = race.winner
+            now = time.monotonic()
+            for attempt in live:
+                if attempt is not race.winner:
+                    self.stats.record_latency(attempt[0].id, now - attempt[3])
+                    attempt[1].cancel(attempt[2])
+            self.stats.record_latency(node.id, race.first_at - start)
+            await connection.check_response(request, "download")
+            self.stats.record_throughput(node.id, copies[0][0].size if length is None else length,
+                                         time.monotonic() - race.first_at)
+
+        finally:
+            for node, connection, request, start in started:
+                if request is not None:
+                    connection.cancel(request)
+                    # the request's sink leads back to the race and the writer, which would keep the part's
+                    # buffer alive until the cycle collector found it
+                    request.open_sink = request.sink = None
+                if connection is not None:
+                    self.checkin(connection)
+                self.stats.end(node.id)
+            started.clear()
+            race.writer = None
+            writer.close()
+
+    async def delete_part(self, node, name):
+        connection = self.checkout(node)
+        try:
+            request = connection.new_request()
+            await connection.send_frame(util.op_delete, request.request_id, util.s_to_bytes(name))
+            await connection.check_response(request, "delete")
+        finally:
+            self.checkin(connection)
+
+    async def search_file_parts(self, node, substr):
+        # returns the access names of the node's parts containing substr
+        connection = self.checkout(node)
+        try:
+            response = bytearray()
+            request = connection.new_request(lambda frame: util.ViewWriter(response))
+            await connection.send_frame(util.op_search, request.request_id, payload=substr)
+            await connection.check_response(request, "search")
+        finally:
+            self.checkin(connection)
+        response = util.s_from_bytes(response)
+
+        return [] if response == "" else response.split(",")
+
+    async def try_upload_part(self, node, name, chunks):
+        # like upload_part, but returns the message of a socket.error instead of raising it
+        return (await self.gather([self.upload_part(node, name, chunks)]))[0]
+
+    async def try_download_replicas_to(self, copies, writer, offset, length):
+        # like download_replicas_to, but returns the message of a socket.error instead of raising it
+        return (await self.gather([self.download_replicas_to(copies, writer, offset, length)]))[0]
+
+    async def upload_parts(self, jobs):
+        # jobs is a list of (node, name, chunks)
+        return await self.gather([self.upload_part(*job) for job in jobs])
+
+    async def download_replicas(self, jobs):
+        # jobs is a list of (copies, writer, offset, length)
+        return await self.gather([self.download_replicas_to(*job) for job in jobs])
+
+    async def delete_parts(self, jobs):
+        # jobs is a list of (node, name)
+        return await self.gather([self.delete_part(*job) for job in jobs])
+
+    async def search_nodes(self, nodes, substr):
+        return await self.gather([self.search_file_parts(node, substr) for node in nodes])
@@ -31,6 +31,7 @@ def main(args):
               "\n\ttotal_space"
               "\n\tshow_files"
               "\n\tshow_lost_files"
+              "\n\tstats"
               "\n\tclose"
               "\n\tupload [path/to/file]"
               "\n\tdownload [file_id]"
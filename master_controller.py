@@ -1,42 +1,268 @@
 import sys
 import socket
 import threading
-import sqlite3
 import os
 import time
-import select
 import datetime
 import math
+import heapq
+import array
+import queue
+import secrets
+import shutil
+import tempfile
+import collections
+import itertools
+import concurrent.futures
 if __name__ == "__main__":
     import util
+    import database
+    import master_async
 else:
     from . import util
+    from . import database
+    from . import master_async
 
 
 class ConnectionInfo:
     def __init__(self):
         self.socket = None
         self.address = None
+        self.node_id = -1
+        self.storage_space = 0
+        self.peer_port = None  # None if the slave can't take copies from other slaves
+
+
+class Request:
+    def __init__(self, request_id, open_sink=None):
+        self.request_id = request_id
+        self.open_sink = open_sink  # called with the first response frame, returns where the payload is written
+        self.sink = None
+        self.frame = None
+        self.error = None
+        self.last_activity = time.monotonic()
+        self.done = threading.Event()
+
+
+class NodeConnection:
+    """
+    A connection to a slave which any number of requests can use at once. Requests are told apart by their
+    request_id, and a reader thread hands each response frame to the request it belongs to as it arrives, so
+    responses can come back in any order and small requests don't wait behind large transfers.
+    """
+    def __init__(self, sock):
+        self.socket = sock
+        self.pending = {}  # key: request_id  value: Request waiting on a response
+        self.request_ids = itertools.count(1)
+        self.closed = False
+        self.users = 0  # transfers which have this connection checked out
+
+        # locks
+        self.send_lock = threading.Lock()
+        self.pending_lock = threading.Lock()
+
+        self.reader = threading.Thread(target=self.read_loop, daemon=True)
+        self.reader.start()
+
+    def new_request(self, open_sink=None):
+        request = Request(next(self.request_ids) & 0xFFFFFFFF, open_sink)
+        self.pending_lock.acquire()
+        if self.closed:
+            self.pending_lock.release()
+            raise socket.error("connection closed")
+        self.pending[request.request_id] = request
+        self.pending_lock.release()
+
+        return request
+
+    def send_frame(self, opcode, request_id=0, meta=b"", payload=b"", status=util.status_ok, flags=0):
+        util.send_frame(self.socket, opcode, request_id, meta, payload, status, flags, lock=self.send_lock)
+
+    def send_message(self, opcode, request_id, meta, chunks):
+        util.send_message(self.socket, opcode, request_id, meta, chunks, lock=self.send_lock)
+
+    def get_response(self, request, timeout=util.slave_response_timeout):
+        """
+        Waits for the whole response to the given request and returns its first frame. The request fails if
+        nothing arrives for it within timeout seconds
+        :param request:
+        :param timeout:
+        :return:
+        """
+        request.last_activity = max(request.last_activity, time.monotonic())
+        while not request.done.wait(timeout):
+            if self.timed_out(request, timeout):
+                self.cancel(request)
+                raise socket.error("response time out")
+
+        if request.error is not None:
+            raise socket.error(request.error)
+
+        return request.frame
+
+    def check_response(self, request, action, timeout=util.slave_response_timeout):
+        # like get_response, but failures reported by the slave are raised as errors
+        frame = self.get_response(request, timeout)
+        if frame.status != util.status_ok:
+            raise socket.error(action + " failed: " + util.s_from_bytes(frame.meta))
+
+        return frame
+
+    def timed_out(self, request, timeout):
+        return not request.done.is_set() and time.monotonic() - request.last_activity >= timeout
+
+    def cancel(self, request):
+        """
+        Gives up on the given request. Anything still to come for it is thrown away, and the slave is told so it
+        can stop sending
+        :param request:
+        :return:
+        """
+        self.pending_lock.acquire()
+        was_pending = self.pending.pop(request.request_id, None) is not None
+        self.pending_lock.release()
+
+        if was_pending:
+            request.error = "request cancelled"
+            request.done.set()
+            try:
+                self.send_frame(util.op_cancel, request.request_id)
+            except socket.error:
+                pass
+
+    def read_loop(self):
+        try:
+            while True:
+                frame = util.recv_frame_header(self.socket)
+
+                self.pending_lock.acquire()
+                request = self.pending.get(frame.request_id)
+                self.pending_lock.release()
+
+                if request is None:
+                    # the request was given up on, throw away whatever is still coming for it
+                    for chunk in util.recv_chunks(self.socket, frame.payload_len):
+                        pass
+                    continue
+
+                request.last_activity = time.monotonic()
+                if request.frame is None:
+                    request.frame = frame
+                    if frame.status == util.status_ok and request.open_sink is not None:
+                        try:
+                            request.sink = request.open_sink(frame)
+                        except Exception as e:
+                            request.error = str(e)
+                elif frame.opcode != util.op_data:
+                    raise util.ProtocolError("expected the rest of response " + str(frame.request_id))
+                elif frame.status != util.status_ok:
+                    request.error = "transfer aborted by the slave"
+
+                for chunk in util.recv_chunks(self.socket, frame.payload_len):
+                    if request.sink is not None and request.error is None:
+                        try:
+                            request.sink.write(chunk)
+                        except Exception as e:
+                            request.error = str(e)
+
+                if not frame.flags & util.flag_more:
+                    self.pending_lock.acquire()
+                    self.pending.pop(frame.request_id, None)
+                    self.pending_lock.release()
+                    request.done.set()
+
+        except (socket.error, ValueError) as e:
+            self.fail_all("connection lost: " + str(e))
+
+    def fail_all(self, error):
+        self.pending_lock.acquire()
+        self.closed = True
+        requests = list(self.pending.values())
+        self.pending.clear()
+        self.pending_lock.release()
+
+        for request in requests:
+            request.error = error
+            request.done.set()
+
+    def close(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.socket.close()
+        self.fail_all("connection closed")
 
 
 class SlaveNode:
+    __slots__ = ["connection", "data_connections", "token", "address", "id", "storage_space", "status", "pool_lock",
+                 "peer_port"]
+
     def __init__(self):
-        self.socket = None
+        self.connection = None  # the control connection
+        self.data_connections = []  # the pool of connections file parts are sent over
+        self.token = None
         self.address = None
         self.id = -1
         self.storage_space = 0
         self.status = "not_set"
+        self.peer_port = None  # the port other slaves can send the node copies on, None if it can't take them
 
         # locks
-        self.socket_lock = threading.Lock()
+        self.pool_lock = threading.Lock()
+
+    def connect(self, sock):
+        # replace any old connections with a new control connection over the given socket
+        self.disconnect()
+        self.connection = NodeConnection(sock)
+
+    def attach(self, sock):
+        # add a data connection over the given socket to the pool
+        connection = NodeConnection(sock)
+        self.pool_lock.acquire()
+        self.data_connections.append(connection)
+        self.pool_lock.release()
+
+    def checkout(self):
+        """
+        Returns the data connection with the fewest transfers using it, or the control connection if the node has
+        no data connections. Every checkout must be matched by a checkin once the transfer is done
+        :return:
+        """
+        self.pool_lock.acquire()
+        self.data_connections = [x for x in self.data_connections if not x.closed]
+        if len(self.data_connections) == 0:
+            connection = self.connection
+        else:
+            connection = min(self.data_connections, key=lambda var: var.users)
+            connection.users += 1
+        self.pool_lock.release()
+
+        return connection
+
+    def checkin(self, connection):
+        self.pool_lock.acquire()
+        if connection is not self.connection:
+            connection.users -= 1
+        self.pool_lock.release()
+
+    def disconnect(self):
+        if self.connection is not None:
+            self.connection.close()
+
+        self.pool_lock.acquire()
+        for connection in self.data_connections:
+            connection.close()
+        self.data_connections = []
+        self.pool_lock.release()
 
     def to_string(self):
         return str(self.id) + " " + str(self.storage_space) + " " + str(self.address)
 
     @staticmethod
     def get_slave_nodes(status=None):
-        # open the connection
-        conn = sqlite3.connect(util.database)
+        # get this thread's connection
+        conn = database.connect()
         c = conn.cursor()
 
         if status is None:
@@ -54,14 +280,12 @@ class SlaveNode:
             node.status = row[2]
             nodes.append(node)
 
-        conn.close()
-
         return nodes
 
     @staticmethod
     def get_slave_node(id):
-        # open the connection
-        conn = sqlite3.connect(util.database)
+        # get this thread's connection
+        conn = database.connect()
         c = conn.cursor()
 
         params = (id,)
@@ -75,14 +299,12 @@ class SlaveNode:
             node.storage_space = row[1]
             node.status = row[2]
 
-        conn.close()
-
         return node
 
     @staticmethod
     def update_slave_node(node):
-        # open the connection
-        conn = sqlite3.connect(util.database)
+        # get this thread's connection
+        conn = database.connect()
         c = conn.cursor()
 
         params = (node.status, node.storage_space, node.id)
@@ -91,13 +313,11 @@ class SlaveNode:
                      status = ?,
                      storage_space = ?
                      WHERE id = ?''', params)
-        conn.commit()
-        conn.close()
 
     @staticmethod
     def insert_slave_node(node):
-        # open the connection
-        conn = sqlite3.connect(util.database)
+        # get this thread's connection
+        conn = database.connect()
         c = conn.cursor()
 
         params = (node.status, node.storage_space)
@@ -109,24 +329,21 @@ class SlaveNode:
                      (?,
                       ?)''', params)
         node.id = c.lastrowid
-        conn.commit()
-        conn.close()
 
     @staticmethod
     def clear_db():
-        # open the connection
-        conn = sqlite3.connect(util.database)
+        # get this thread's connection
+        conn = database.connect()
         c = conn.cursor()
 
         c.execute('''
                     DELETE FROM tbl_slave_node
                     ''')
 
-        conn.commit()
-        conn.close()
-
 
 class File:
+    __slots__ = ["id", "name", "size", "upload_date", "folder_id", "status"]
+
     def __init__(self):
         self.id = -1
         self.name = ""
@@ -140,8 +357,8 @@ class File:
 
     @staticmethod
     def get_files():
-        # open the connection
-        conn = sqlite3.connect(util.database)
+        # get this thread's connection
+        conn = database.connect()
         c = conn.cursor()
 
         c.execute("SELECT * FROM tbl_file WHERE status IS NULL OR status != 'lost'")
@@ -158,14 +375,12 @@ class File:
             file.status = row[5]
             files.append(file)
 
-        conn.close()
-
         return files
 
     @staticmethod
     def get_lost_files():
-        # open the connection
-        conn = sqlite3.connect(util.database)
+        # get this thread's connection
+        conn = database.connect()
         c = conn.cursor()
 
         c.execute("SELECT * FROM tbl_file WHERE status = 'lost'")
@@ -182,14 +397,12 @@ class File:
             file.status = row[5]
             files.append(file)
 
-        conn.close()
-
         return files
 
     @staticmethod
     def get_danger_files():
-        # open the connection
-        conn = sqlite3.connect(util.database)
+        # get this thread's connection
+        conn = database.connect()
         c = conn.cursor()
 
         c.execute("SELECT * FROM tbl_file WHERE status = 'danger'")
@@ -206,14 +419,48 @@ class File:
             file.status = row[5]
             files.append(file)
 
-        conn.close()
-
         return files
 
+    @staticmethod
+    def get_damaged_file_copies():
+        """
+        Counts the copies left of the parts of every lost file and file in danger, in one query grouped by file and
+        sequence number. Files without any parts at all aren't returned
+        :return: a list of (file, last_sequence, sequences, min_copies) where last_sequence is the highest
+                 sequence number of the file's parts, lost or not, sequences is how many sequence numbers have at
+                 least one copy which isn't lost, and min_copies is the fewest copies which aren't lost of any
+                 sequence number that has a part
+        """
+        # get this thread's connection
+        conn = database.connect()
+        c = conn.cursor()
+
+        c.execute('''SELECT f.*, s.last_sequence, s.sequences, s.min_copies
+                     FROM tbl_file f JOIN
+                        (SELECT file_id,
+                                MAX(sequence_order) AS last_sequence,
+                                SUM(copies > 0) AS sequences,
+                                MIN(copies) AS min_copies
+                         FROM
+                            (SELECT file_id, sequence_order, SUM(status IS NULL OR status != 'lost') AS copies
+                             FROM tbl_file_part
+                             WHERE file_id IN (SELECT id FROM tbl_file WHERE status IN ('lost', 'danger'))
+                             GROUP BY file_id, sequence_order)
+                         GROUP BY file_id) s
+                     ON s.file_id = f.id''')
+
+        return [(File.from_row(row[:6]), row[6], row[7], row[8]) for row in c]
+
     @staticmethod
     def get_file(id):
-        # open the connection
-        conn = sqlite3.connect(util.database)
+        entry = MetadataCache.get(id)
+        if entry is not None and entry[0] is not None:
+            return File.from_row(entry[0])
+
+        writes = MetadataCache.begin_fill()
+
+        # get this thread's connection
+        conn = database.connect()
         c = conn.cursor()
 
         params = (id,)
@@ -222,22 +469,31 @@ class File:
         row = c.fetchone()
         file = None
         if row is not None:
-            file = File()
-            file.id = row[0]
-            file.name = row[1]
-            file.size = row[2]
-            file.upload_date = util.datetime_from_s(row[3])
-            file.folder_id = row[4]
-            file.status = row[5]
+            file = File.from_row(row)
+            MetadataCache.fill(id, writes, file_row=row)
+
+        return file
 
-        conn.close()
+    @staticmethod
+    def from_row(row):
+        file = File()
+        file.id = row[0]
+        file.name = row[1]
+        file.size = row[2]
+        file.upload_date = util.datetime_from_s(row[3])
+        file.folder_id = row[4]
+        file.status = row[5]
 
         return file
 
+    @staticmethod
+    def to_row(file):
+        return file.id, file.name, file.size, util.datetime_to_s(file.upload_date), file.folder_id, file.status
+
     @staticmethod
     def insert_file(file):
-        # open the connection
-        conn = sqlite3.connect(util.database)
+        # get this thread's connection
+        conn = database.connect()
         c = conn.cursor()
 
         params = (file.name, file.size, util.datetime_to_s(file.upload_date), file.folder_id, file.status)
@@ -255,13 +511,14 @@ class File:
                             ?,
                             ?)''', params)
         file.id = c.lastrowid
-        conn.commit()
-        conn.close()
+
+        # a new file has no parts yet
+        MetadataCache.set_file(File.to_row(file), [])
 
     @staticmethod
     def update_file(file):
-        # open the connection
-        conn = sqlite3.connect(util.database)
+        # get this thread's connection
+        conn = database.connect()
         c = conn.cursor()
 
         params = (file.name, file.size, file.folder_id, file.status, file.id)
@@ -273,37 +530,63 @@ class File:
                         status = ?
                     WHERE id = ?''', params)
 
-        conn.commit()
-        conn.close()
+        MetadataCache.set_file(File.to_row(file))
+
+    @staticmethod
+    def update_files(files):
+        # like update_file, but all of the given files are written in one transaction
+        with database.transaction() as conn:
+            c = conn.cursor()
+
+            params = [(file.name, file.size, file.folder_id, file.status, file.id) for file in files]
+
+            c.executemany('''UPDATE tbl_file SET
+                                name = ?,
+                                size = ?,
+                                folder_id = ?,
+                                status = ?
+                            WHERE id = ?''', params)
+
+        for file in files:
+            MetadataCache.set_file(File.to_row(file))
 
     @staticmethod
     def delete_file(file):
-        # open the connection
-        conn = sqlite3.connect(util.database)
-        c = conn.cursor()
+        # deletes the file along with the rows of its parts still left, the lost ones included, and gives the space
+        # they were counted for back to their nodes
+        used = {}
+        with database.transaction() as conn:
+            c = conn.cursor()
+
+            params = (file.id,)
 
-        params = (file.id,)
+            c.execute('''SELECT node_id, SUM(size) FROM tbl_file_part WHERE file_id = ? GROUP BY node_id''', params)
+            for row in c.fetchall():
+                used[row[0]] = -row[1]
+            c.execute('''DELETE FROM tbl_file_part WHERE file_id = ?''', params)
+            SpaceLedger.persist_used(c, used)
 
-        c.execute('''DELETE FROM tbl_file WHERE id = ?
-                            ''', params)
+            c.execute('''DELETE FROM tbl_file WHERE id = ?
+                                ''', params)
 
-        conn.commit()
-        conn.close()
+        SpaceLedger.add_used(used)
+        MetadataCache.remove_file(file.id)
 
     @staticmethod
     def clear_db():
-        # open the connection
-        conn = sqlite3.connect(util.database)
+        # get this thread's connection
+        conn = database.connect()
         c = conn.cursor()
 
         c.execute('''DELETE FROM tbl_file
                         ''')
 
-        conn.commit()
-        conn.close()
+        MetadataCache.clear()
 
 
 class Folder:
+    __slots__ = ["id", "parent_id", "name", "children"]
+
     def __init__(self):
         self.id = -1
         self.parent_id = -1
@@ -312,8 +595,8 @@ class Folder:
 
     @staticmethod
     def get_folders():
-        # open the connection
-        conn = sqlite3.connect(util.database)
+        # get this thread's connection
+        conn = database.connect()
         c = conn.cursor()
 
         c.execute("SELECT * FROM tbl_folder")
@@ -328,14 +611,12 @@ class Folder:
 
             folders.append(folder)
 
-        conn.close()
-
         return folders
 
     @staticmethod
     def get_folder(id):
-        # open the connection
-        conn = sqlite3.connect(util.database)
+        # get this thread's connection
+        conn = database.connect()
         c = conn.cursor()
 
         params = (id,)
@@ -349,14 +630,12 @@ class Folder:
             folder.parent_id = row[1]
             folder.name = row[2]
 
-        conn.close()
-
         return folder
 
     @staticmethod
     def insert_folder(folder):
-        # open the connection
-        conn = sqlite3.connect(util.database)
+        # get this thread's connection
+        conn = database.connect()
         c = conn.cursor()
 
         params = (folder.parent_id, folder.name)
@@ -369,13 +648,11 @@ class Folder:
                                 ?)''', params)
 
         folder.id = c.lastrowid
-        conn.commit()
-        conn.close()
 
     @staticmethod
     def update_folder_name(folder):
-        # open the connection
-        conn = sqlite3.connect(util.database)
+        # get this thread's connection
+        conn = database.connect()
         c = conn.cursor()
 
         params = (folder.name, folder.id)
@@ -384,9 +661,6 @@ class Folder:
                             name = ?
                      WHERE id = ?''', params)
 
-        conn.commit()
-        conn.close()
-
     @staticmethod
     def update_folder_parent(folder, parent):
         # make sure the given parent isn't actually a child of the folder
@@ -395,8 +669,8 @@ class Folder:
         elif folder.id == 1:
             raise Exception("Cannot move the root folder")
 
-        # open the connection
-        conn = sqlite3.connect(util.database)
+        # get this thread's connection
+        conn = database.connect()
         c = conn.cursor()
 
         params = (parent.id, folder.id)
@@ -405,9 +679,6 @@ class Folder:
                             parent_id = ?
                      WHERE id = ?''', params)
 
-        conn.commit()
-        conn.close()
-
         folder.parent_id = parent.id
 
     @staticmethod
@@ -416,17 +687,14 @@ class Folder:
         if len(files) > 0:
             raise Exception("The folder is not empty.")
 
-        # open the connection
-        conn = sqlite3.connect(util.database)
+        # get this thread's connection
+        conn = database.connect()
         c = conn.cursor()
 
         params = (folder.id,)
 
         c.execute('''DELETE FROM tbl_folder WHERE id = ?''', params)
 
-        conn.commit()
-        conn.close()
-
     @staticmethod
     def get_folder_map():
         folders = Folder.get_folders()
@@ -472,17 +740,16 @@ class Folder:
 
     @staticmethod
     def clear_db():
-        # open the connection
-        conn = sqlite3.connect(util.database)
+        # get this thread's connection
+        conn = database.connect()
         c = conn.cursor()
 
         c.execute('''DELETE FROM tbl_folder WHERE id != 1''')
 
-        conn.commit()
-        conn.close()
-
 
 class FilePart:
+    __slots__ = ["id", "file_id", "node_id", "access_name", "sequence_order", "size", "status"]
+
     def __init__(self):
         self.id = -1
         self.file_id = -1
@@ -494,8 +761,8 @@ class FilePart:
 
     @staticmethod
     def get_file_parts():
-        # open the connection
-        conn = sqlite3.connect(util.database)
+        # get this thread's connection
+        conn = database.connect()
         c = conn.cursor()
 
         c.execute("SELECT * FROM tbl_file_part WHERE status IS NULL OR status != 'lost'")
@@ -513,14 +780,12 @@ class FilePart:
             part.status = row[6]
             file_parts.append(part)
 
-        conn.close()
-
         return file_parts
 
     @staticmethod
     def get_lost_file_parts():
-        # open the connection
-        conn = sqlite3.connect(util.database)
+        # get this thread's connection
+        conn = database.connect()
         c = conn.cursor()
 
         c.execute("SELECT * FROM tbl_file_part WHERE status = 'lost'")
@@ -538,14 +803,101 @@ class FilePart:
             part.status = row[6]
             file_parts.append(part)
 
-        conn.close()
+        return file_parts
+
+    @staticmethod
+    def select_file_parts(where, params=()):
+        # returns the parts matching the given WHERE clause
+        # get this thread's connection
+        conn = database.connect()
+        c = conn.cursor()
+
+        c.execute("SELECT * FROM tbl_file_part WHERE " + where, params)
+
+        return [FilePart.from_row(row) for row in c.fetchall()]
+
+    @staticmethod
+    def get_part_rows_by_file(file_id):
+        # returns the rows of all the file's parts, lost or not, from the cache if it has them
+        entry = MetadataCache.get(file_id)
+        if entry is not None and entry[1] is not None:
+            return entry[1]
+
+        writes = MetadataCache.begin_fill()
+
+        # get this thread's connection
+        conn = database.connect()
+        c = conn.cursor()
+
+        params = (file_id,)
+        c.execute("SELECT * FROM tbl_file_part WHERE file_id = ?", params)
+
+        rows = c.fetchall()
+        MetadataCache.fill(file_id, writes, part_rows=rows)
+
+        return rows
+
+    @staticmethod
+    def get_file_parts_by_file(file_id):
+        return [FilePart.from_row(row) for row in FilePart.get_part_rows_by_file(file_id) if row[6] != 'lost']
+
+    @staticmethod
+    def get_lost_file_parts_by_file(file_id):
+        return [FilePart.from_row(row) for row in FilePart.get_part_rows_by_file(file_id) if row[6] == 'lost']
+
+    @staticmethod
+    def select_part_columns(where, params=()):
+        # like select_file_parts, but the parts are returned as PartColumns
+        # get this thread's connection
+        conn = database.connect()
+        c = conn.cursor()
+
+        c.execute("SELECT * FROM tbl_file_part WHERE " + where, params)
+
+        # the rows are read as they're stored, so the whole result is never held as rows
+        columns = PartColumns()
+        for row in c:
+            columns.append(row)
+
+        return columns
+
+    @staticmethod
+    def get_node_part_columns(node_id):
+        return FilePart.select_part_columns("node_id = ? AND (status IS NULL OR status != 'lost')", (node_id,))
+
+    @staticmethod
+    def get_file_parts_by_names(names):
+        names = list(names)
+        file_parts = []
+        # keep under the limit on the number of parameters in one statement
+        for start in range(0, len(names), 500):
+            batch = names[start:start + 500]
+            file_parts += FilePart.select_file_parts("access_name IN (" + ",".join(["?"] * len(batch)) +
+                                                     ") AND (status IS NULL OR status != 'lost')", batch)
 
         return file_parts
 
+    @staticmethod
+    def from_row(row):
+        part = FilePart()
+        part.id = row[0]
+        part.file_id = row[1]
+        part.node_id = row[2]
+        part.access_name = row[3]
+        part.sequence_order = row[4]
+        part.size = row[5]
+        part.status = row[6]
+
+        return part
+
+    @staticmethod
+    def to_row(part):
+        return part.id, part.file_id, part.node_id, part.access_name, part.sequence_order, part.size, part.status
+
     @staticmethod
     def get_file_part(id):
-        # open the connection
-        conn = sqlite3.connect(util.database)
+        # get this thread's connection
+        conn = database.connect()
         c = conn.cursor()
 
         params = (id,)
@@ -563,40 +915,40 @@ class FilePart:
             part.size = row[5]
             part.status = row[6]
 
-        conn.close()
-
         return part
 
     @staticmethod
     def insert_file_part(part):
-        # open the connection
-        conn = sqlite3.connect(util.database)
-        c = conn.cursor()
-
-        params = (part.file_id, part.node_id, part.access_name, part.sequence_order, part.size, part.status)
-
-        c.execute('''INSERT INTO tbl_file_part
-                             (  file_id,
-                                node_id,
-                                access_name,
-                                sequence_order,
-                                size,
-                                status)
-                             VALUES
-                             (  ?,
-                                ?,
-                                ?,
-                                ?,
-                                ?,
-                                ?)''', params)
-        part.id = c.lastrowid
-        conn.commit()
-        conn.close()
+        # the part's size is added to its node's used space along with it
+        with database.transaction() as conn:
+            c = conn.cursor()
+
+            params = (part.file_id, part.node_id, part.access_name, part.sequence_order, part.size, part.status)
+
+            c.execute('''INSERT INTO tbl_file_part
+                                 (  file_id,
+                                    node_id,
+                                    access_name,
+                                    sequence_order,
+                                    size,
+                                    status)
+                                 VALUES
+                                 (  ?,
+                                    ?,
+                                    ?,
+                                    ?,
+                                    ?,
+                                    ?)''', params)
+            part.id = c.lastrowid
+            SpaceLedger.persist_used(c, {part.node_id: part.size})
+
+        SpaceLedger.add_used({part.node_id: part.size})
+        MetadataCache.set_part(FilePart.to_row(part))
 
     @staticmethod
     def update_file_part(part):
-        # open the connection
-        conn = sqlite3.connect(util.database)
+        # get this thread's connection
+        conn = database.connect()
         c = conn.cursor()
 
         params = (part.file_id, part.node_id, part.access_name, part.sequence_order, part.size, part.status, part.id)
@@ -610,267 +962,1294 @@ class FilePart:
                             status = ?
                      WHERE id = ?''', params)
 
-        conn.commit()
-        conn.close()
+        MetadataCache.set_part(FilePart.to_row(part))
 
     @staticmethod
     def delete_file_part(part):
-        # open the connection
-        conn = sqlite3.connect(util.database)
-        c = conn.cursor()
+        # the part's size is taken off its node's used space along with it
+        with database.transaction() as conn:
+            c = conn.cursor()
 
-        params = (part.id,)
+            params = (part.id,)
 
-        c.execute('''DELETE FROM tbl_file_part WHERE id = ?
-                                ''', params)
+            c.execute('''DELETE FROM tbl_file_part WHERE id = ?
+                                    ''', params)
+            deleted = c.rowcount > 0
+            if deleted:
+                SpaceLedger.persist_used(c, {part.node_id: -part.size})
 
-        conn.commit()
-        conn.close()
+        if deleted:
+            SpaceLedger.add_used({part.node_id: -part.size})
+        MetadataCache.remove_part(part.file_id, part.id)
 
     @staticmethod
-    def clear_db():
-        # open the connection
-        conn = sqlite3.connect(util.database)
-        c = conn.cursor()
+    def insert_file_parts(parts):
+        """
+        Inserts all of the given parts in one transaction, along with the change in their nodes' used space
+        :param parts:
+        :return:
+        """
+        if len(parts) == 0:
+            return
+
+        used = {}
+        for part in parts:
+            used[part.node_id] = used.get(part.node_id, 0) + part.size
+
+        with database.transaction() as conn:
+            c = conn.cursor()
+
+            # nothing else can insert while the transaction is open, so the ids after the highest are free
+            c.execute("SELECT COALESCE(MAX(id), 0) FROM tbl_file_part")
+            next_id = c.fetchone()[0] + 1
+            for index, part in enumerate(parts):
+                part.id = next_id + index
+
+            c.executemany('''INSERT INTO tbl_file_part
+                                 (  id,
+                                    file_id,
+                                    node_id,
+                                    access_name,
+                                    sequence_order,
+                                    size,
+                                    status)
+                                 VALUES
+                                 (  ?,
+                                    ?,
+                                    ?,
+                                    ?,
+                                    ?,
+                                    ?,
+                                    ?)''', [FilePart.to_row(part) for part in parts])
+            SpaceLedger.persist_used(c, used)
+
+        SpaceLedger.add_used(used)
+        for part in parts:
+            MetadataCache.set_part(FilePart.to_row(part))
 
-        c.execute('''DELETE FROM tbl_file_part
-                            ''')
+    @staticmethod
+    def delete_file_parts(parts):
+        # deletes all of the given parts in one transaction, along with the change in their nodes' used space
+        used = {}
+        deleted = []
+        with database.transaction() as conn:
+            c = conn.cursor()
+
+            for part in parts:
+                params = (part.id,)
+                c.execute('''DELETE FROM tbl_file_part WHERE id = ?''', params)
+                if c.rowcount > 0:
+                    used[part.node_id] = used.get(part.node_id, 0) - part.size
+                    deleted.append(part)
+
+            SpaceLedger.persist_used(c, used)
+
+        SpaceLedger.add_used(used)
+        for part in deleted:
+            MetadataCache.remove_part(part.file_id, part.id)
 
-        conn.commit()
-        conn.close()
+    @staticmethod
+    def set_node_parts_status(node_id, status):
+        """
+        Sets the status of every part on the given node in one statement, status being 'lost' or None
+        :param node_id:
+        :param status:
+        :return: the number of parts changed
+        """
+        # get this thread's connection
+        conn = database.connect()
+        c = conn.cursor()
 
+        params = (status, node_id, status)
+        c.execute('''UPDATE tbl_file_part SET
+                            status = ?
+                     WHERE node_id = ? AND status IS NOT ?''', params)
+        changed = c.rowcount
 
-class WelcomeSocket:
-    def __init__(self, new_client_callback=None, port=15719):
-        self.welcome_socket = None
-        self.callback = new_client_callback
-        self.port = port
+        MetadataCache.set_node_status(node_id, status)
 
-    def open_welcome_conn(self):
-        # create an INET, STREAMing socket
-        self.welcome_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # bind the socket to a public host, and a well-known port
-        self.welcome_socket.bind(("", self.port))
-        # become a server socket
-        self.welcome_socket.listen(5)
+        return changed
 
-        print("Welcoming socket: " + socket.gethostname(), " ", str(self.port))
+    @staticmethod
+    def clear_db():
+        with database.transaction() as conn:
+            c = conn.cursor()
 
-        while True:
-            # accept connections from outside
-            (client_socket, address) = self.welcome_socket.accept()
+            c.execute('''DELETE FROM tbl_file_part
+                                ''')
+            c.execute('''UPDATE tbl_slave_node SET used_space = 0''')
 
-            client = ConnectionInfo()
-            client.address = address
-            client.socket = client_socket
+        SpaceLedger.load()
+        MetadataCache.clear()
+        PartCache.clear()
 
-            print("New connection created")
 
-            self.callback(client)
+class PartColumns:
+    """
+    A set of file parts kept a column at a time in arrays instead of as a FilePart per part, for scans over a large
+    share of the parts such as everything on a node. Access names are only kept for parts whose name isn't the usual
+    file_id + "_" + sequence_order, so a part takes about 41 bytes rather than the 250 of a FilePart
+    """
+    __slots__ = ["id", "file_id", "node_id", "access_names", "sequence_order", "size", "lost"]
 
-        self.welcome_socket.close()
+    def __init__(self):
+        self.id = array.array("q")
+        self.file_id = array.array("q")
+        self.node_id = array.array("q")
+        self.access_names = {}  # key: index  value: access name, for the parts not named the usual way
+        self.sequence_order = array.array("q")
+        self.size = array.array("q")
+        self.lost = array.array("b")  # 1 if the part's status is 'lost'
+
+    def __len__(self):
+        return len(self.id)
+
+    def append(self, row):
+        # row is a row of tbl_file_part
+        self.id.append(row[0])
+        self.file_id.append(row[1])
+        self.node_id.append(row[2])
+        if row[3] != str(row[1]) + "_" + str(row[4]):
+            self.access_names[len(self.id) - 1] = row[3]
+        self.sequence_order.append(row[4])
+        self.size.append(row[5])
+        self.lost.append(1 if row[6] == 'lost' else 0)
+
+    def part(self, index):
+        # returns the part at the given index as a FilePart
+        part = FilePart()
+        part.id = self.id[index]
+        part.file_id = self.file_id[index]
+        part.node_id = self.node_id[index]
+        part.access_name = self.access_names.get(index, str(part.file_id) + "_" + str(self.sequence_order[index]))
+        part.sequence_order = self.sequence_order[index]
+        part.size = self.size[index]
+        part.status = 'lost' if self.lost[index] else None
 
+        return part
 
-class Master:
-    def __init__(self):
-        # member variables
-        self.nodes = []
-        self.ready = False
-        self.command_socket = None
-        self.execute = True
-        self.busy = False
-        self.command_thread = None
 
-        # locks
-        self.nodes_lock = threading.Lock()
+class SpaceLedger:
+    """
+    Keeps the bytes used on each node in memory, so placing a file doesn't mean adding up every part in the
+    database. The used bytes are also kept in tbl_slave_node.used_space, which changes in the same transaction as
+    the parts do. Uploads still being sent hold a reservation for the space their parts will take, so two uploads
+    at once can't both be given the same free space
+    """
+    used = {}  # key: node_id  value: bytes of the parts stored on the node, lost or not
+    reserved = {}  # key: node_id  value: bytes held for uploads still being sent to the node
 
-        # check if an existing database already exists
-        if not os.path.isfile(util.database):
-            print("First time setup")
-            self.setup_db()
+    # locks
+    lock = threading.RLock()
 
-        else:
-            connected_nodes = SlaveNode.get_slave_nodes("connected")
-            self.nodes = connected_nodes
+    @staticmethod
+    def load():
+        # get this thread's connection
+        conn = database.connect()
+        c = conn.cursor()
 
-        # set up the welcoming socket for new threads
-        print("Create welcome thread")
-        welcome_activity = WelcomeSocket(new_client_callback=self.accept_new_node)
-        welcome_thread = threading.Thread(target=welcome_activity.open_welcome_conn, daemon=True)
-        welcome_thread.start()
+        c.execute("SELECT id, used_space FROM tbl_slave_node")
 
-        # start the synchronization period for already connected nodes
-        print("Start synchronization period")
-        wait_time = util.restart_window
-        while len([x for x in self.nodes if x.status == "connected"]) > 0 and wait_time > 0:
-            wait_time -= util.wait_interval
-            time.sleep(util.wait_interval)
-        print("End synchronization period")
+        rows = c.fetchall()
+        with SpaceLedger.lock:
+            SpaceLedger.used = {}
+            for row in rows:
+                SpaceLedger.used[row[0]] = row[1]
 
-        # get our set of nodes to start with
-        for node in self.nodes:
-            if node.status == "connected":  # node never reconnected, is now lost
-                self.lose_node(node)
-            else:  # either it's a new node, or an existing one that has reconnected
-                node.status = "connected"
-                SlaveNode.update_slave_node(node)
+    @staticmethod
+    def persist_used(c, changes):
+        # writes the changes in the nodes' used space with the cursor of the transaction making them
+        # changes is a dict of  key: node_id  value: bytes added to the node, negative if taken off
+        params = [(change, node_id) for node_id, change in changes.items()]
+        c.executemany('''UPDATE tbl_slave_node SET used_space = used_space + ? WHERE id = ?''', params)
 
-        # set up command socket
-        # create an INET, STREAMing socket
-        print("Create command socket")
-        self.command_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # bind the socket to a public host, and a well-known port
-        self.command_socket.bind(("localhost", util.command_port))
-        # become a server socket
-        self.command_socket.listen(5)
+    @staticmethod
+    def add_used(changes):
+        with SpaceLedger.lock:
+            for node_id, change in changes.items():
+                SpaceLedger.used[node_id] = SpaceLedger.used.get(node_id, 0) + change
 
-        # set up the continuous connection thread
-        print("Create continuous connection thread")
-        con_thread = threading.Thread(target=self.continuous_connection, daemon=True)
-        con_thread.start()
+    @staticmethod
+    def get_available(node):
+        with SpaceLedger.lock:
+            return node.storage_space - SpaceLedger.used.get(node.id, 0) - SpaceLedger.reserved.get(node.id, 0)
 
-        # ready to begin normal execution
-        self.ready = True
+    @staticmethod
+    def reserve(reservation):
+        # reservation is a dict of  key: node_id  value: bytes to hold on the node
+        with SpaceLedger.lock:
+            for node_id, size in reservation.items():
+                SpaceLedger.reserved[node_id] = SpaceLedger.reserved.get(node_id, 0) + size
 
-    def continuous_connection(self):
-        while self.execute:
-            if not self.busy:
-                threads = []
-                for node in self.nodes:
-                    t = threading.Thread(target=self.check_connection, args=(node,))
-                    threads.append(t)
-                    t.start()
-                for t in threads:
-                    t.join()
-            time.sleep(util.master_continuous_wait)
+    @staticmethod
+    def release(reservation):
+        with SpaceLedger.lock:
+            for node_id, size in reservation.items():
+                SpaceLedger.reserved[node_id] -= size
+                if SpaceLedger.reserved[node_id] <= 0:
+                    del SpaceLedger.reserved[node_id]
+
+
+class NodeStats:
+    """
+    Keeps moving averages of how long each node takes to start answering a download and how fast it sends once it
+    has, along with how many downloads it has going. Each part is read from the copy expected to finish first, and
+    a download whose node hasn't started answering by the time util.hedge_percentile of the recent ones had is
+    asked of another copy as well
+    """
+    latency = {}  # key: node_id  value: seconds until the first frame of a download arrives
+    throughput = {}  # key: node_id  value: bytes per second of a download once it has started
+    active = {}  # key: node_id  value: downloads running
+    recent = collections.deque(maxlen=256)  # latencies of the latest downloads from every node
+    min_samples = 20  # latencies needed before the percentile is trusted
+
+    # locks
+    lock = threading.Lock()
 
-    def check_connection(self, node):
-        try:
-            node.socket_lock.acquire()
-            # send connect command
-            node.socket.sendall(util.s_to_bytes("OPEN"))
-            ready = select.select([node.socket], [], [], util.master_continuous_wait)
-            if ready[0]:
-                response = util.s_from_bytes(node.socket.recv(util.bufsize))
-            else:
-                response = "FAIL"
+    @staticmethod
+    def average(old, sample):
+        if old is None:
+            return sample
+        return old + util.node_stats_weight * (sample - old)
 
-            node.socket_lock.release()
+    @staticmethod
+    def begin(node_id):
+        with NodeStats.lock:
+            NodeStats.active[node_id] = NodeStats.active.get(node_id, 0) + 1
 
-            if response != "OPEN":
-                raise socket.error("invalid response")
-        except socket.error:
-            # give it time to reconnect/recover
-            node.status = "recovery"
-            print("Recovery mode")
+    @staticmethod
+    def end(node_id):
+        with NodeStats.lock:
+            NodeStats.active[node_id] -= 1
 
-            # close the socket so the client can attempt to reconnect
-            node.socket.shutdown(socket.SHUT_RDWR)
-            node.socket.close()
+    @staticmethod
+    def record_latency(node_id, seconds):
+        with NodeStats.lock:
+            NodeStats.latency[node_id] = NodeStats.average(NodeStats.latency.get(node_id), seconds)
+            NodeStats.recent.append(seconds)
 
-            time.sleep(util.slave_reconnect_window)
-            if node.status == "recovery":
-                self.lose_node(node)
+    @staticmethod
+    def record_throughput(node_id, size, seconds):
+        # a part smaller than a chunk says little about the speed of the node
+        if size < util.transfer_bufsize:
+            return
+        with NodeStats.lock:
+            NodeStats.throughput[node_id] = NodeStats.average(NodeStats.throughput.get(node_id),
+                                                              size / max(seconds, 1e-6))
 
-    def lose_node(self, node):
-        node.status = "lost"
+    @staticmethod
+    def estimate(node_id, size, planned=0):
+        """
+        Returns the seconds a download of size bytes from the node is expected to take, slowed down by the downloads
+        the node already has going and the planned ones about to be started
+        :param node_id:
+        :param size:
+        :param planned:
+        :return:
+        """
+        with NodeStats.lock:
+            latency = NodeStats.latency.get(node_id, util.hedge_min_delay)
+            throughput = NodeStats.throughput.get(node_id)
+            load = NodeStats.active.get(node_id, 0) + planned
 
-        # remove the node from the array
-        self.nodes_lock.acquire()
-        self.nodes.remove(node)
-        self.nodes_lock.release()
+        transfer = size / throughput if throughput else 0.0
+        return (latency + transfer) * (1 + load)
 
-        SlaveNode.update_slave_node(node)
+    @staticmethod
+    def hedge_delay():
+        # the seconds to wait for a download to start answering before another copy is asked
+        if util.hedge_percentile <= 0:
+            return float("inf")
+        with NodeStats.lock:
+            samples = sorted(NodeStats.recent)
+        if len(samples) < NodeStats.min_samples:
+            return util.slave_response_timeout / 2
+
+        index = min(len(samples) - 1, int(len(samples) * util.hedge_percentile))
+        return max(samples[index], util.hedge_min_delay)
 
-        print("Node lost")
-        # PANIC MODE!!!! -- need to back up all of the file parts that only existed on this node
-        all_parts = FilePart.get_file_parts()
-        other_parts = []
-        node_parts = []
-        # separate the parts contained in the node and not
-        for part in all_parts:
-            if part.node_id == node.id:
-                node_parts.append(part)
-            else:
-                other_parts.append(part)
+    @staticmethod
+    def stats():
+        # returns a dict of  key: node_id  value: (latency, throughput, active downloads) of the nodes measured
+        with NodeStats.lock:
+            return dict([(node_id, (latency, NodeStats.throughput.get(node_id), NodeStats.active.get(node_id, 0)))
+                         for node_id, latency in NodeStats.latency.items()])
+
+
+class MetadataCache:
+    """
+    Keeps the rows of recently used files and their parts in memory, so downloading a file whose metadata is cached
+    doesn't touch the database at all. The model's insert, update and delete methods write through to it once
+    their change is committed. It holds at most util.metadata_cache_size rows, and the files used least recently
+    are dropped to make room. A lookup which missed only adds what it read from the database if nothing was written
+    while it was reading, so a slow reader can't put back rows older than what's in the database
+    """
+    entries = collections.OrderedDict()  # key: file_id  value: [file row or None, list of part rows or None]
+    size = 0  # rows held
+    writes = 0  # changes written through so far
+
+    # locks
+    lock = threading.Lock()
 
-        # set each of these parts to be lost
-        for part in node_parts:
-            part.status = 'lost'
-            FilePart.update_file_part(part)
-
-        # group the other parts by the file_id and sequence_number
-        file_part_map = {}
-        for part in other_parts:
-            if part.file_id not in file_part_map:
-                file_part_map[part.file_id] = {}
-            if part.sequence_order not in file_part_map[part.file_id]:
-                file_part_map[part.file_id][part.sequence_order] = []
-            file_part_map[part.file_id][part.sequence_order].append(part)
-
-        # try to recover any parts on the node that can be
-        for part in node_parts:
-            try:
-                # if the file_id isn't in the map, then no other copies exist and the file is lost
-                if part.file_id not in file_part_map or part.sequence_order not in file_part_map[part.file_id]:
-                    raise Exception("No other copies of a necessary part exist")
+    @staticmethod
+    def load():
+        """
+        Fills the cache with the newest files and their parts until it's full
+        :return:
+        """
+        # get this thread's connection
+        conn = database.connect()
+        file_cursor = conn.cursor()
+        part_cursor = conn.cursor()
+
+        file_cursor.execute("SELECT * FROM tbl_file ORDER BY id DESC")
+        part_cursor.execute("SELECT * FROM tbl_file_part ORDER BY file_id DESC")
+
+        # walk both tables newest file first, the parts of each file come right after those of the newer files
+        entries = []
+        size = 0
+        part_row = part_cursor.fetchone()
+        for file_row in file_cursor:
+            while part_row is not None and part_row[1] > file_row[0]:
+                part_row = part_cursor.fetchone()
+            part_rows = []
+            while part_row is not None and part_row[1] == file_row[0]:
+                part_rows.append(part_row)
+                part_row = part_cursor.fetchone()
+
+            size += 1 + len(part_rows)
+            if size > util.metadata_cache_size:
+                break
+            entries.append((file_row, part_rows))
 
-            except Exception as e:
-                file = File.get_file(part.file_id)
-                print("File (" + file.to_string() + ") lost: " + str(e))
-                file.status = "lost"
-                File.update_file(file)
+        with MetadataCache.lock:
+            MetadataCache.entries.clear()
+            MetadataCache.size = 0
+            # the newest files go in last so they're the last to be dropped
+            for file_row, part_rows in reversed(entries):
+                MetadataCache.entries[file_row[0]] = [file_row, part_rows]
+                MetadataCache.size += 1 + len(part_rows)
+
+    @staticmethod
+    def get(file_id):
+        with MetadataCache.lock:
+            entry = MetadataCache.entries.get(file_id)
+            if entry is not None:
+                MetadataCache.entries.move_to_end(file_id)
+
+            return entry
+
+    @staticmethod
+    def begin_fill():
+        # must be called before reading what will be given to fill
+        return MetadataCache.writes
+
+    @staticmethod
+    def fill(file_id, writes, file_row=None, part_rows=None):
+        # adds what a lookup which missed read from the database, unless something was written in the meantime
+        with MetadataCache.lock:
+            if writes != MetadataCache.writes:
+                return
+            entry = MetadataCache.get_entry(file_id)
+            if file_row is not None:
+                MetadataCache.set_entry(file_id, file_row, entry[1])
+            if part_rows is not None:
+                MetadataCache.set_entry(file_id, entry[0], list(part_rows))
+
+    @staticmethod
+    def set_file(file_row, part_rows=None):
+        # part_rows is only given when the file's parts are known, like for a file which was just inserted
+        with MetadataCache.lock:
+            MetadataCache.writes += 1
+            entry = MetadataCache.get_entry(file_row[0])
+            MetadataCache.set_entry(file_row[0], file_row, entry[1] if part_rows is None else list(part_rows))
+
+    @staticmethod
+    def remove_file(file_id):
+        with MetadataCache.lock:
+            MetadataCache.writes += 1
+            entry = MetadataCache.entries.pop(file_id, None)
+            if entry is not None:
+                MetadataCache.size -= MetadataCache.entry_size(entry)
+
+    @staticmethod
+    def set_part(part_row):
+        # adds or replaces the part, if the file's parts are cached
+        with MetadataCache.lock:
+            MetadataCache.writes += 1
+            entry = MetadataCache.entries.get(part_row[1])
+            if entry is not None and entry[1] is not None:
+                part_rows = [row for row in entry[1] if row[0] != part_row[0]] + [part_row]
+                MetadataCache.set_entry(part_row[1], entry[0], part_rows)
+
+    @staticmethod
+    def remove_part(file_id, part_id):
+        with MetadataCache.lock:
+            MetadataCache.writes += 1
+            entry = MetadataCache.entries.get(file_id)
+            if entry is not None and entry[1] is not None:
+                MetadataCache.set_entry(file_id, entry[0], [row for row in entry[1] if row[0] != part_id])
+
+    @staticmethod
+    def set_node_status(node_id, status):
+        # sets the status of every cached part on the given node
+        with MetadataCache.lock:
+            MetadataCache.writes += 1
+            for file_id, entry in list(MetadataCache.entries.items()):
+                if entry[1] is not None and any([row[2] == node_id and row[6] != status for row in entry[1]]):
+                    part_rows = [row[:6] + (status,) if row[2] == node_id else row for row in entry[1]]
+                    MetadataCache.entries[file_id] = [entry[0], part_rows]
+
+    @staticmethod
+    def clear():
+        with MetadataCache.lock:
+            MetadataCache.writes += 1
+            MetadataCache.entries.clear()
+            MetadataCache.size = 0
+
+    @staticmethod
+    def get_entry(file_id):
+        # the lock must be held
+        entry = MetadataCache.entries.get(file_id)
+        if entry is None:
+            entry = [None, None]
+
+        return entry
+
+    @staticmethod
+    def set_entry(file_id, file_row, part_rows):
+        # the lock must be held. The entries are replaced rather than changed, so one given out by get stays as it was
+        old_entry = MetadataCache.entries.pop(file_id, None)
+        if old_entry is not None:
+            MetadataCache.size -= MetadataCache.entry_size(old_entry)
+
+        entry = [file_row, part_rows]
+        MetadataCache.entries[file_id] = entry
+        MetadataCache.size += MetadataCache.entry_size(entry)
+
+        # drop the files used least recently until there's room
+        while MetadataCache.size > util.metadata_cache_size and len(MetadataCache.entries) > 1:
+            file_id, old_entry = MetadataCache.entries.popitem(last=False)
+            MetadataCache.size -= MetadataCache.entry_size(old_entry)
+
+    @staticmethod
+    def entry_size(entry):
+        return 1 + (len(entry[1]) if entry[1] is not None else 0)
+
+
+class PartCache:
+    """
+    Keeps the contents of recently downloaded parts in memory by access_name, so a file downloaded over and over is
+    served from the master instead of its slaves. It holds at most util.part_cache_size bytes, and the parts used
+    least recently are dropped to make room, or moved to a directory under util.part_cache_spill when it's set.
+    Parts bigger than a quarter of the cache aren't kept. Only download_file fills the cache, from the file it has
+    already downloaded, so the paths which write straight to disk or stream never hold a part for it. Deleting or
+    repairing parts invalidates them, and a download which started before an invalidation doesn't add what it read,
+    so a stale part can't be put back
+    """
+    entries = collections.OrderedDict()  # key: access_name  value: contents
+    spilled = collections.OrderedDict()  # key: access_name  value: bytes in the part's spill file
+    size = 0  # bytes held in memory
+    filling = 0  # bytes being copied in by fills which haven't been put yet
+    spilled_size = 0  # bytes held in the spill directory
+    spill_dir = None  # made the first time a part is spilled
+    invalidations = 0  # invalidations so far
+    hits = 0
+    misses = 0
+    evictions = 0
+
+    # locks
+    lock = threading.Lock()
+
+    @staticmethod
+    def cacheable(size):
+        return util.part_cache_size > 0 and size <= util.part_cache_size // 4
+
+    @staticmethod
+    def begin_fill():
+        # must be called before starting the downloads whose contents will be given to put
+        return PartCache.invalidations
+
+    @staticmethod
+    def get(name):
+        """
+        Returns the contents of the part with the given access_name, or None if it isn't cached. A part found in the
+        spill directory is moved back into memory
+        :param name:
+        :return:
+        """
+        with PartCache.lock:
+            contents = PartCache.entries.get(name)
+            if contents is not None:
+                PartCache.entries.move_to_end(name)
+                PartCache.hits += 1
+                return contents
+            if name not in PartCache.spilled:
+                PartCache.misses += 1
+                return None
+            invalidations = PartCache.invalidations
+            path = os.path.join(PartCache.spill_dir, name)
+
+        try:
+            with open(path, mode='rb') as file:
+                contents = bytearray(file.read())
+        except OSError:
+            # dropped from the spill directory in the meantime
+            contents = None
+
+        with PartCache.lock:
+            if contents is None:
+                PartCache.misses += 1
+                return None
+            PartCache.hits += 1
+        PartCache.put(name, contents, invalidations)
+
+        return contents
+
+    @staticmethod
+    def fill(view, parts, invalidations):
+        """
+        Copies the parts of a downloaded file into the cache. Each copy is reserved against util.part_cache_size,
+        along with the copies of any other fills running, before it's made, and parts which don't fit are skipped
+        :param view: the contents of the file
+        :param parts: a list of (access_name, offset, size) of the parts of the file which were read whole
+        :param invalidations: what begin_fill returned before the file was downloaded
+        :return:
+        """
+        total = 0
+        for name, offset, size in parts:
+            if not PartCache.cacheable(size):
                 continue
+            total += size
+            if total > util.part_cache_size:
+                # the rest would only push out the parts of this file already added
+                return
+            with PartCache.lock:
+                if PartCache.filling + size > util.part_cache_size:
+                    continue
+                PartCache.filling += size
+            try:
+                PartCache.put(name, bytearray(view[offset:offset + size]), invalidations)
+            finally:
+                with PartCache.lock:
+                    PartCache.filling -= size
+
+    @staticmethod
+    def put(name, contents, invalidations):
+        """
+        Adds the contents of a part, unless something was invalidated since begin_fill returned invalidations
+        :param name:
+        :param contents:
+        :param invalidations:
+        :return:
+        """
+        if not PartCache.cacheable(len(contents)):
+            return
+
+        dropped = []
+        with PartCache.lock:
+            if invalidations != PartCache.invalidations:
+                return
+            old = PartCache.entries.pop(name, None)
+            if old is not None:
+                PartCache.size -= len(old)
+            PartCache.entries[name] = contents
+            PartCache.size += len(contents)
+
+            while PartCache.size > util.part_cache_size:
+                old_name, old = PartCache.entries.popitem(last=False)
+                PartCache.size -= len(old)
+                PartCache.evictions += 1
+                dropped.append((old_name, old))
+
+        if util.part_cache_spill != "":
+            for old_name, old in dropped:
+                PartCache.spill(old_name, old, invalidations)
 
+    @staticmethod
+    def spill(name, contents, invalidations):
+        # writes a part dropped from memory to the spill directory, dropping the oldest ones there to make room
+        with PartCache.lock:
+            if PartCache.spill_dir is None:
+                try:
+                    PartCache.spill_dir = tempfile.mkdtemp(prefix="part_cache_", dir=util.part_cache_spill)
+                except OSError as e:
+                    print("Part cache can't spill: " + str(e))
+                    return
+            path = os.path.join(PartCache.spill_dir, name)
+
+        try:
+            with open(path, mode='wb') as file:
+                file.write(contents)
+        except OSError as e:
+            print("Part cache can't spill: " + str(e))
+            return
+
+        removed = []
+        with PartCache.lock:
+            if invalidations != PartCache.invalidations:
+                removed.append(name)
+            else:
+                PartCache.spilled_size += len(contents) - PartCache.spilled.pop(name, 0)
+                PartCache.spilled[name] = len(contents)
+                while PartCache.spilled_size > util.part_cache_spill_size:
+                    old_name, old_size = PartCache.spilled.popitem(last=False)
+                    PartCache.spilled_size -= old_size
+                    removed.append(old_name)
+            spill_dir = PartCache.spill_dir
+
+        PartCache.remove_spilled(spill_dir, removed)
+
+    @staticmethod
+    def remove_spilled(spill_dir, names):
+        for name in names:
             try:
-                # if we don't have enough copies to reach the redundancy level, we need try
-                # and back up what we can
-                cur_level = len(file_part_map[part.file_id][part.sequence_order])
-                if cur_level < util.redundant_level:
-                    # get the nodes that don't contain a copy
-                    copy_ids = [y.node_id for y in file_part_map[part.file_id][part.sequence_order]]
-                    nodes = [x for x in self.nodes if x.id not in copy_ids]
-                    if len(nodes) + cur_level < util.redundant_level:
-                        raise Exception("Not enough nodes exist to reach the redundancy level")
-                    else:
-                        # try and make new copies
-                        copy_part = file_part_map[part.file_id][part.sequence_order][0]
-                        node = self.get_connected_node(copy_part.node_id)
-                        rtn = [None] * 1
-                        self.download_part(node, copy_part.access_name, rtn, 0)
-                        if isinstance(rtn[0], str):
-                            raise Exception(rtn[0])
-                        else:
-                            contents = rtn[0]
-                            # copy the file_part to each other node
-                            while cur_level < util.redundant_level:
-                                rtn[0] = None
+                os.remove(os.path.join(spill_dir, name))
+            except OSError:
+                pass
+
+    @staticmethod
+    def invalidate(names):
+        # drops the parts with the given access_names, and keeps any download already running from adding them
+        removed = []
+        with PartCache.lock:
+            PartCache.invalidations += 1
+            for name in names:
+                contents = PartCache.entries.pop(name, None)
+                if contents is not None:
+                    PartCache.size -= len(contents)
+                if name in PartCache.spilled:
+                    PartCache.spilled_size -= PartCache.spilled.pop(name)
+                    removed.append(name)
+            spill_dir = PartCache.spill_dir
+
+        PartCache.remove_spilled(spill_dir, removed)
+
+    @staticmethod
+    def clear():
+        with PartCache.lock:
+            PartCache.invalidations += 1
+            PartCache.entries.clear()
+            PartCache.spilled.clear()
+            PartCache.size = 0
+            PartCache.spilled_size = 0
+            spill_dir = PartCache.spill_dir
+            PartCache.spill_dir = None
+
+        if spill_dir is not None:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+    @staticmethod
+    def stats():
+        with PartCache.lock:
+            lookups = PartCache.hits + PartCache.misses
+            return {"size": PartCache.size, "parts": len(PartCache.entries), "spilled": PartCache.spilled_size,
+                    "hits": PartCache.hits, "misses": PartCache.misses, "evictions": PartCache.evictions,
+                    "hit_ratio": PartCache.hits / lookups if lookups > 0 else 0.0}
+
+
+class RepairScheduler:
+    """
+    Copies the parts which lost copies with a node back up to the redundancy level. Each repair is a
+    (file_id, sequence_order) kept in tbl_repair until it's done, so the work left when the master stops is picked up
+    again when it starts. The most urgent repairs go first: the parts with the fewest copies left, then the parts of
+    the smallest files, which gets the most files back to full redundancy soonest. Repairs run on their own workers
+    and stream each part from a node with a copy straight to the nodes getting one, with at most
+    util.repair_node_streams transfers reading from or writing to any one node at a time. Repairs which can't go
+    ahead because there aren't enough nodes with room wait until another node connects, and repairs which fail
+    are tried again on the next heartbeat
+    """
+    def __init__(self, master):
+        self.master = master
+        self.heap = []  # (copies, file size, file_id, sequence_order) of the repairs waiting for a worker
+        self.queued = set()  # (file_id, sequence_order) of the repairs in the heap or being worked on
+        self.parked = {}  # key: (file_id, sequence_order)  value: heap entry of a repair waiting for nodes
+        self.retries = {}  # key: (file_id, sequence_order)  value: heap entry of a repair which failed
+        self.streams = {}  # key: node_id  value: repair transfers reading from or writing to the node
+        self.started = False
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.workers = util.WorkerPool(util.repair_workers, "repair")
 
-                                node = nodes[-1]
-                                nodes.pop()
+        # locks
+        self.cond = threading.Condition()
 
-                                self.upload_part(node, copy_part.access_name, contents, rtn, 0)
-                                if rtn[0] is not None:
-                                    raise Exception(rtn[0])
+    def load(self):
+        """
+        Queues the repairs in tbl_repair, with the copies each part has left
+        :return:
+        """
+        # get this thread's connection
+        conn = database.connect()
+        c = conn.cursor()
 
-                                new_part = FilePart()
-                                new_part.node_id = node.id
-                                new_part.file_id = copy_part.file_id
-                                new_part.access_name = copy_part.access_name
-                                new_part.sequence_order = copy_part.sequence_order
-                                new_part.size = copy_part.size
-                                FilePart.insert_file_part(new_part)
+        c.execute('''SELECT r.file_id, r.sequence_order, COUNT(p.id), COALESCE(f.size, 0)
+                     FROM tbl_repair r
+                     LEFT JOIN tbl_file f ON f.id = r.file_id
+                     LEFT JOIN tbl_file_part p ON p.file_id = r.file_id AND p.sequence_order = r.sequence_order
+                                                  AND (p.status IS NULL OR p.status != 'lost')
+                     GROUP BY r.file_id, r.sequence_order''')
 
-                                cur_level += 1
+        self.queue(c.fetchall())
 
-                # else we're good
+    def start(self):
+        # the queued repairs only go to the workers from here on
+        with self.cond:
+            self.started = True
+            count = len(self.heap)
+        for index in range(count):
+            self.workers.submit(self.run_next)
 
-            except Exception as e:
-                file = File.get_file(part.file_id)
-                print("File (" + file.to_string() + ") in danger: " + str(e))
-                file.status = "danger"
-                File.update_file(file)
-                continue
+    def schedule(self, repairs):
+        """
+        Saves the given repairs in tbl_repair and queues them
+        :param repairs: a list of (file_id, sequence_order, copies, file size)
+        :return:
+        """
+        if len(repairs) == 0:
+            return
+
+        with database.transaction() as conn:
+            c = conn.cursor()
+
+            c.executemany('''INSERT OR IGNORE INTO tbl_repair (file_id, sequence_order) VALUES (?, ?)''',
+                          [repair[:2] for repair in repairs])
+
+        count = self.queue(repairs)
+        if self.started:
+            for index in range(count):
+                self.workers.submit(self.run_next)
+
+    def queue(self, repairs):
+        # returns how many of the repairs weren't already queued
+        count = 0
+        with self.cond:
+            for file_id, sequence_order, copies, size in repairs:
+                key = (file_id, sequence_order)
+                self.parked.pop(key, None)
+                self.retries.pop(key, None)
+                if key not in self.queued:
+                    self.queued.add(key)
+                    heapq.heappush(self.heap, (copies, size, file_id, sequence_order))
+                    count += 1
+
+        return count
+
+    def resume(self):
+        # queues the repairs waiting for nodes again, called when a node connects
+        with self.cond:
+            entries = list(self.parked.values()) + list(self.retries.values())
+            self.parked = {}
+            self.retries = {}
+
+        self.requeue(entries)
+
+    def retry(self):
+        # queues the repairs which failed again, called on every heartbeat
+        with self.cond:
+            entries = list(self.retries.values())
+            self.retries = {}
+
+        self.requeue(entries)
+
+    def requeue(self, entries):
+        count = self.queue([(file_id, sequence_order, copies, size)
+                            for copies, size, file_id, sequence_order in entries])
+        if self.started:
+            for index in range(count):
+                self.workers.submit(self.run_next)
+
+    def run_next(self):
+        # every job a worker is given runs the most urgent repair at the time
+        with self.cond:
+            if len(self.heap) == 0:
+                return
+            entry = heapq.heappop(self.heap)
+            self.active += 1
+
+        failed = False
+        try:
+            done = self.repair(entry[2], entry[3], entry[1])
+        except Exception as e:
+            print("Repair of part " + str(entry[3]) + " of file " + str(entry[2]) + " failed: " + str(e))
+            done = False
+            failed = True
+
+        key = (entry[2], entry[3])
+        if done:
+            with database.transaction() as conn:
+                c = conn.cursor()
+
+                c.execute('''DELETE FROM tbl_repair WHERE file_id = ? AND sequence_order = ?''', key)
+
+        with self.cond:
+            self.active -= 1
+            self.queued.discard(key)
+            if done:
+                self.completed += 1
+            elif failed:
+                self.failed += 1
+                self.retries[key] = entry
+            else:
+                self.parked[key] = entry
+
+    def repair(self, file_id, sequence_order, size):
+        """
+        Copies the part to as many nodes as it takes to reach the redundancy level
+        :param file_id:
+        :param sequence_order:
+        :param size: the size of the file, only used for the order of the repairs
+        :return: True if the repair is finished, False if it has to wait for more nodes. A copy which fails to be
+                 sent raises, so the repair is retried instead
+        """
+        file = File.get_file(file_id)
+        if file is None:  # deleted since
+            return True
+
+        copies = [part for part in FilePart.get_file_parts_by_file(file_id) if part.sequence_order == sequence_order]
+        if len(copies) >= util.redundant_level:  # the part's node came back, or it was repaired already
+            self.update_file_status(file)
+            return True
+        if len(copies) == 0:  # nothing left to copy from
+            self.update_file_status(file)
+            return True
+
+        source, targets = self.take_transfer(copies, util.redundant_level - len(copies))
+        if source is None:
+            return False
+
+        try:
+            new_parts = []
+            for node in targets:
+                new_part = FilePart()
+                new_part.node_id = node.id
+                new_part.file_id = source.file_id
+                new_part.access_name = source.access_name
+                new_part.sequence_order = source.sequence_order
+                new_part.size = source.size
+                new_parts.append(new_part)
+
+            node = self.master.get_connected_node(source.node_id)
+            msgs = [None] * len(targets)
+            relay = []  # indexes of the targets the part goes to through the master
+            for index, target in enumerate(targets):
+                if util.peer_replication and node.peer_port is not None and target.peer_port is not None:
+                    # the source sends the part straight to the target, the master only hands out the grant
+                    self.master.replicate_part(node, source.access_name, target, msgs, index)
+                    if msgs[index] is None:
+                        continue
+                    print(msgs[index])
+                relay.append(index)
+
+            if len(relay) > 0:
+                # the part goes from the source to every target left at once, a chunk at a time
+                relayed = self.master.upload_copies([(targets[index], new_parts[index]) for index in relay],
+                                                    self.master.iter_part(node, source.access_name))
+                for index, msg in zip(relay, relayed):
+                    msgs[index] = msg
+            errors = [msg for msg in msgs if msg is not None]
+            new_parts = [part for index, part in enumerate(new_parts) if msgs[index] is None]
+
+            if File.get_file(file_id) is None:
+                # the file was deleted while it was being copied, so the new copies aren't wanted either
+                for part in new_parts:
+                    self.master.delete_part(self.master.get_connected_node(part.node_id), part.access_name,
+                                            [None], 0)
+                return True
+            FilePart.insert_file_parts(new_parts)
+            PartCache.invalidate([source.access_name])
+
+        finally:
+            self.give_transfer(source, targets)
+
+        self.update_file_status(file)
+        if len(errors) > 0:
+            raise socket.error("copying the part failed: " + "; ".join(errors))
+
+        # the part can only still be short of copies if there weren't enough nodes with room for them
+        return len(copies) + len(new_parts) >= util.redundant_level
+
+    def take_transfer(self, copies, needed):
+        """
+        Waits for a connected node with one of the copies and up to needed connected nodes with room for another
+        one to each have a free stream, and takes those streams along with the space for the new copies
+        :param copies:
+        :param needed:
+        :return: (part to copy, nodes to copy it to), or (None, []) if there aren't any nodes to copy from or to
+        """
+        size = copies[0].size
+        holders = set([part.node_id for part in copies])
+        with self.cond:
+            while True:
+                nodes = [node for node in self.master.nodes if node.status != "recovery"]
+                node_ids = set([node.id for node in nodes])
+                sources = [part for part in copies if part.node_id in node_ids]
+                with SpaceLedger.lock:
+                    targets = [node for node in nodes
+                               if node.id not in holders and SpaceLedger.get_available(node) >= size]
+                    if len(sources) == 0 or len(targets) == 0:
+                        return None, []
+
+                    sources = [part for part in sources
+                               if self.streams.get(part.node_id, 0) < util.repair_node_streams]
+                    targets = [node for node in targets if self.streams.get(node.id, 0) < util.repair_node_streams]
+                    if len(sources) > 0 and len(targets) > 0:
+                        # spread the transfers over the least busy nodes, and the new copies over the emptiest
+                        source = min(sources, key=lambda part: self.streams.get(part.node_id, 0))
+                        targets.sort(key=lambda node: (self.streams.get(node.id, 0), -SpaceLedger.get_available(node)))
+                        targets = targets[:needed]
+
+                        for node_id in [source.node_id] + [node.id for node in targets]:
+                            self.streams[node_id] = self.streams.get(node_id, 0) + 1
+                        SpaceLedger.reserve(dict([(node.id, size) for node in targets]))
+
+                        return source, targets
+
+                self.cond.wait(util.wait_interval)
+
+    def give_transfer(self, source, targets):
+        SpaceLedger.release(dict([(node.id, source.size) for node in targets]))
+        with self.cond:
+            for node_id in [source.node_id] + [node.id for node in targets]:
+                self.streams[node_id] -= 1
+                if self.streams[node_id] == 0:
+                    del self.streams[node_id]
+            self.cond.notify_all()
+
+    @staticmethod
+    def update_file_status(file):
+        """
+        Sets the file's status from the copies its parts have: None with enough copies of every part to reach the
+        redundancy level, danger with at least one copy of every part, lost otherwise
+        :param file:
+        :return:
+        """
+        copies = {}  # key: sequence_order  value: copies which aren't lost
+        for part in FilePart.get_file_parts_by_file(file.id):
+            copies[part.sequence_order] = copies.get(part.sequence_order, 0) + 1
+        sequences = set(copies.keys()) | set([part.sequence_order
+                                               for part in FilePart.get_lost_file_parts_by_file(file.id)])
+        if len(sequences) == 0:
+            return
+
+        if any([copies.get(sequence_order, 0) == 0 for sequence_order in range(max(sequences) + 1)]):
+            status = "lost"
+        elif min(copies.values()) < util.redundant_level:
+            status = "danger"
+        else:
+            status = None
+
+        if status != file.status:
+            file.status = status
+            File.update_file(file)
+
+    def stats(self):
+        with self.cond:
+            return {"active": self.active, "queued": len(self.heap), "parked": len(self.parked),
+                    "completed": self.completed, "failed": self.failed}
+
+
+class FileReader:
+    """
+    Reads a stored file in order, like a file opened for reading. The file is downloaded in ranges of
+    util.readahead_size bytes, and the next window of ranges are downloaded in the background while the caller reads
+    the current one, so no more than window + 1 ranges are held in memory at once
+    """
+    def __init__(self, master, file_obj, window=None):
+        self.master = master
+        self.file_obj = file_obj
+        self.window = max(1, util.readahead_window if window is None else window)
+        self.ranges = collections.deque()  # (copies, offset, length) of each range of a part still to be started
+        for copies in master.get_download_replicas(file_obj):
+            size = copies[0][0].size
+            for offset in range(0, size, util.readahead_size):
+                self.ranges.append((copies, offset, min(util.readahead_size, size - offset)))
+        self.in_flight = collections.deque()  # (future, contents, writer) of each range started, in order
+        self.current = memoryview(b"")  # what the caller hasn't read yet of the current range
+        self.closed = False
+
+        self.fill()
+
+    def fill(self):
+        # starts downloading ranges until the window is full
+        while len(self.in_flight) < self.window and len(self.ranges) > 0:
+            copies, offset, length = self.ranges.popleft()
+            contents = bytearray(length)
+            writer = util.ViewWriter(memoryview(contents))
+            self.in_flight.append((self.master.start_read(copies, writer, offset, length), contents, writer))
+
+    def next_range(self):
+        # waits for the next range and returns its contents, or None at the end of the file
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if len(self.in_flight) == 0:
+            return None
+
+        future, contents, writer = self.in_flight.popleft()
+        self.fill()
+        error = future.result()
+        if error is None and writer.pos != len(contents):
+            error = "download ended early"
+        if error is not None:
+            raise Exception("Error receiving file: " + error)
+
+        return contents
+
+    def read(self, size=-1):
+        """
+        Returns the next size bytes of the file, or the rest of it if size is negative. Fewer bytes are only
+        returned at the end of the file
+        :param size:
+        :return:
+        """
+        chunks = []
+        while size != 0:
+            if len(self.current) == 0:
+                contents = self.next_range()
+                if contents is None:
+                    break
+                self.current = memoryview(contents)
+
+            count = len(self.current) if size < 0 else min(size, len(self.current))
+            chunks.append(self.current[:count])
+            self.current = self.current[count:]
+            if size > 0:
+                size -= count
+
+        return b"".join(chunks)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # the file is iterated a range at a time, each as a bytearray
+        if len(self.current) > 0:
+            chunk = bytearray(self.current)
+            self.current = memoryview(b"")
+            return chunk
+
+        contents = self.next_range()
+        if contents is None:
+            raise StopIteration
+        return contents
+
+    def close(self):
+        # the downloads which haven't started yet are dropped, the ones already running finish on their own
+        for future, contents, writer in self.in_flight:
+            future.cancel()
+        self.in_flight.clear()
+        self.ranges.clear()
+        self.current = memoryview(b"")
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class WelcomeSocket:
+    def __init__(self, new_client_callback=None, port=15719):
+        self.welcome_socket = None
+        self.callback = new_client_callback
+        self.port = port
+
+    def open_welcome_conn(self):
+        # create an INET, STREAMing socket
+        self.welcome_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # bind the socket to a public host, and a well-known port
+        self.welcome_socket.bind(("", self.port))
+        # become a server socket
+        self.welcome_socket.listen(5)
+
+        print("Welcoming socket: " + socket.gethostname(), " ", str(self.port))
+
+        while True:
+            # accept connections from outside
+            (client_socket, address) = self.welcome_socket.accept()
+
+            util.tune_socket(client_socket)
+
+            client = ConnectionInfo()
+            client.address = address
+            client.socket = client_socket
+
+            print("New connection created")
+
+            self.callback(client)
+
+        self.welcome_socket.close()
+
+
+class Master:
+    def __init__(self):
+        # member variables
+        self.nodes = []
+        self.ready = False
+        self.command_socket = None
+        self.execute = True
+        self.command_thread = None
+        self.sessions = {}  # key: token given in a node's hello  value: node
+        self.engine = None  # set when the data path runs on asyncio
+
+        # locks
+        self.nodes_lock = threading.Lock()
+
+        # client requests and background upkeep get their own workers so neither can starve the other
+        self.foreground = util.WorkerPool(util.foreground_workers, "foreground")
+        if util.background_workers > 0:
+            self.background = util.WorkerPool(util.background_workers, "background")
+        else:
+            self.background = self.foreground
+
+        if util.master_engine == "asyncio":
+            self.engine = master_async.AsyncEngine(NodeStats)
+
+        # copies parts back up to the redundancy level after a node is lost
+        self.repairs = RepairScheduler(self)
+
+        # check if an existing database already exists
+        if not os.path.isfile(util.database):
+            print("First time setup")
+            self.setup_db()
+
+        else:
+            self.upgrade_db()
+            connected_nodes = SlaveNode.get_slave_nodes("connected")
+            self.nodes = connected_nodes
+
+        SpaceLedger.load()
+        MetadataCache.load()
+        self.repairs.load()
+
+        # set up the welcoming socket for new threads
+        print("Create welcome thread")
+        welcome_activity = WelcomeSocket(new_client_callback=self.accept_new_node)
+        welcome_thread = threading.Thread(target=welcome_activity.open_welcome_conn, daemon=True)
+        welcome_thread.start()
+
+        # start the synchronization period for already connected nodes
+        print("Start synchronization period")
+        wait_time = util.restart_window
+        while len([x for x in self.nodes if x.status == "connected"]) > 0 and wait_time > 0:
+            wait_time -= util.wait_interval
+            time.sleep(util.wait_interval)
+        print("End synchronization period")
+
+        # get our set of nodes to start with
+        for node in self.nodes:
+            if node.status == "connected":  # node never reconnected, is now lost
+                self.lose_node(node)
+            else:  # either it's a new node, or an existing one that has reconnected
+                node.status = "connected"
+                SlaveNode.update_slave_node(node)
+
+        # the repairs left over from before the restart can go now that we know which nodes are here
+        self.repairs.start()
+
+        # set up command socket
+        # create an INET, STREAMing socket
+        print("Create command socket")
+        self.command_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # bind the socket to a public host, and a well-known port
+        self.command_socket.bind(("localhost", util.command_port))
+        # become a server socket
+        self.command_socket.listen(5)
+
+        # set up the continuous connection thread
+        print("Create continuous connection thread")
+        con_thread = threading.Thread(target=self.continuous_connection, daemon=True)
+        con_thread.start()
+
+        # ready to begin normal execution
+        self.ready = True
+
+    def continuous_connection(self):
+        while self.execute:
+            # the heartbeat goes over each node's control connection with either engine, so a node is checked
+            # even before its data connections are attached
+            self.background.run_all(self.check_connection, [(node,) for node in self.nodes])
+            self.repairs.retry()
+            time.sleep(util.master_continuous_wait)
+
+    def check_connection(self, node):
+        try:
+            # send connect command, this goes out between the frames of any transfers already running
+            request = node.connection.new_request()
+            node.connection.send_frame(util.op_open, request.request_id)
+            frame = node.connection.get_response(request, util.master_continuous_wait)
+
+            if frame.opcode != util.op_open:
+                raise socket.error("invalid response")
+        except socket.error:
+            self.recover_node(node)
+
+    def recover_node(self, node):
+        # give it time to reconnect/recover
+        node.status = "recovery"
+        print("Recovery mode")
+
+        # close the sockets so the client can attempt to reconnect
+        node.disconnect()
+        if self.engine is not None:
+            self.engine.detach(node)
+
+        time.sleep(util.slave_reconnect_window)
+        if node.status == "recovery":
+            self.lose_node(node)
+
+    def lose_node(self, node):
+        node.status = "lost"
+
+        # remove the node from the array
+        self.nodes_lock.acquire()
+        self.nodes.remove(node)
+        self.sessions.pop(node.token, None)
+        self.nodes_lock.release()
+
+        SlaveNode.update_slave_node(node)
+
+        print("Node lost")
+        # PANIC MODE!!!! -- need to back up all of the file parts that only existed on this node
+        node_parts = FilePart.get_node_part_columns(node.id)
+
+        # set each of these parts to be lost
+        FilePart.set_node_parts_status(node.id, 'lost')
+
+        # count the copies of those parts which are still on other nodes
+        copies = {}  # key: (file_id, sequence_order)  value: copies which aren't lost
+        for file_id in set(node_parts.file_id):
+            for part in FilePart.get_file_parts_by_file(file_id):
+                key = (part.file_id, part.sequence_order)
+                copies[key] = copies.get(key, 0) + 1
+
+        # the new status of each file which is lost or in danger, written all at once at the end
+        file_statuses = {}  # key: file_id  value: File
+        repairs = {}  # key: (file_id, sequence_order)  value: (copies, file size)
+
+        for file_id, sequence_order in zip(node_parts.file_id, node_parts.sequence_order):
+            key = (file_id, sequence_order)
+            file = file_statuses.get(file_id) or File.get_file(file_id)
+            # if no other copies exist then the file is lost
+            if key not in copies:
+                if file.status != "lost":
+                    print("File (" + file.to_string() + ") lost: No other copies of a necessary part exist")
+                file.status = "lost"
+                file_statuses[file.id] = file
+            # if we don't have enough copies to reach the redundancy level, the part is copied back up to it by
+            # the repair scheduler and the file is in danger until then
+            elif copies[key] < util.redundant_level:
+                repairs[key] = (copies[key], file.size)
+                # a lost file stays lost
+                if file.status != "lost":
+                    file.status = "danger"
+                file_statuses[file.id] = file
+
+        File.update_files(list(file_statuses.values()))
+        self.repairs.schedule([key + value for key, value in repairs.items()])
+        print(str(len(repairs)) + " parts scheduled for repair")
 
         return
 
@@ -887,14 +2266,15 @@ class Master:
         """
         node = SlaveNode()
         node.address = connection_info.address
-        node.socket = connection_info.socket
+        node.connect(connection_info.socket)
         node.status = "connected"
         SlaveNode.insert_slave_node(node)
 
         # send id to the node
-        node.socket.sendall(util.i_to_bytes(node.id))
-        # get the storage space of the new node
-        node.storage_space = util.i_from_bytes(node.socket.recv(util.bufsize))
+        self.send_hello(node)
+        # the storage space of the node came with its hello
+        node.storage_space = connection_info.storage_space
+        node.peer_port = connection_info.peer_port
 
         SlaveNode.update_slave_node(node)
 
@@ -909,13 +2289,31 @@ class Master:
         # UNLOCK
         self.nodes_lock.release()
 
+        # repairs waiting for another node can use this one
+        self.repairs.resume()
+
     def handshake_node(self, connection_info):
         """
         This function should be run in it's own thread.
         :param node:
         :return:
         """
-        id = util.i_from_bytes(connection_info.socket.recv(util.bufsize))
+        frame = util.recv_frame(connection_info.socket)
+        if frame.opcode == util.op_attach:
+            self.attach_node_connection(connection_info, frame)
+            return
+        elif frame.opcode != util.op_hello:
+            print("Invalid handshake")
+            connection_info.socket.close()
+            return
+
+        # the hello carries the node's id and storage space, and the port other slaves can send it copies on
+        hello = util.s_from_bytes(frame.meta).split(" ")
+        connection_info.node_id = int(hello[0])
+        connection_info.storage_space = int(hello[1])
+        if len(hello) > 2:
+            connection_info.peer_port = int(hello[2])
+        id = connection_info.node_id
 
         # if id == -1 then it's a new node
         if id == -1:
@@ -932,52 +2330,34 @@ class Master:
                 if existing_node.status == "lost":  # the prodigal son has returned!
                     existing_node.status = "connected"
                     existing_node.address = connection_info.address
-                    existing_node.socket = connection_info.socket
+                    existing_node.connect(connection_info.socket)
                     # send id to the node
-                    existing_node.socket.sendall(util.i_to_bytes(existing_node.id))
-                    # get the storage space of the new node
-                    existing_node.storage_space = util.i_from_bytes(existing_node.socket.recv(util.bufsize))
+                    self.send_hello(existing_node)
+                    # the storage space of the node came with its hello
+                    existing_node.storage_space = connection_info.storage_space
+                    existing_node.peer_port = connection_info.peer_port
 
                     # update all parts on the node to no longer be lost
-                    parts = [part for part in FilePart.get_lost_file_parts() if part.node_id == existing_node.id]
-                    for part in parts:
-                        part.status = None
-                        FilePart.update_file_part(part)
-
-                    # search each lost file (and file in danger) and see if those files are no longer lost/in danger
-                    lost_files = File.get_lost_files() + File.get_danger_files()
-                    for file in lost_files:
-                        # get the max sequence_number
-                        all_parts = [part.sequence_order for part in FilePart.get_file_parts() if part.file_id == file.id] + \
-                                    [part.sequence_order for part in FilePart.get_lost_file_parts() if part.file_id == file.id]
-                        max_sequence_number = max(all_parts)
-
-                        # map the file parts by sequence_number to make sure we have enough copies of each
-                        parts = [part for part in FilePart.get_file_parts() if part.file_id == file.id]
-                        order_map = {}
-                        for part in parts:
-                            if part.sequence_order not in order_map:
-                                order_map[part.sequence_order] = 0
-                            order_map[part.sequence_order] += 1
-
-                        # make sure there aren't any missing sequence numbers
-                        all_accounted_for = True
-                        redundancy_level = True
-                        for sequence_number in range(max_sequence_number + 1):
-                            if sequence_number not in order_map:
-                                all_accounted_for = False
-                                redundancy_level = False
-                                break
-                            elif order_map[sequence_number] < util.redundant_level:
-                                redundancy_level = False
+                    FilePart.set_node_parts_status(existing_node.id, None)
+
+                    # see if each lost file (and file in danger) is no longer lost/in danger
+                    changed_files = []
+                    for file, last_sequence, sequences, min_copies in File.get_damaged_file_copies():
+                        # every sequence number up to the last one needs a copy which isn't lost
+                        all_accounted_for = sequences == last_sequence + 1
                         # do we have enough copies to have the redundancy level?
-                        if redundancy_level:
-                            file.status = None
-                            File.update_file(file)
+                        if all_accounted_for and min_copies >= util.redundant_level:
+                            status = None
                         # do we have at least enough to no longer be a lost file?
                         elif all_accounted_for:
-                            file.status = "danger"
-                            File.update_file(file)
+                            status = "danger"
+                        else:
+                            status = file.status
+
+                        if status != file.status:
+                            file.status = status
+                            changed_files.append(file)
+                    File.update_files(changed_files)
 
                     SlaveNode.update_slave_node(existing_node)
                     # add the node to the list of nodes
@@ -987,6 +2367,7 @@ class Master:
                     self.nodes.append(existing_node)
                     # UNLOCK
                     self.nodes_lock.release()
+                    self.repairs.resume()
                     print("Lost node connected")
                 else:
                     node = self.get_connected_node(id)
@@ -994,13 +2375,15 @@ class Master:
                     if node.status == "recovery":  # good to go
                         node.status = "connected"
                         node.address = connection_info.address
-                        node.socket = connection_info.socket
+                        node.connect(connection_info.socket)
                         # send id to the node
-                        node.socket.sendall(util.i_to_bytes(node.id))
-                        # get the storage space of the new node
-                        node.storage_space = util.i_from_bytes(node.socket.recv(util.bufsize))
+                        self.send_hello(node)
+                        # the storage space of the node came with its hello
+                        node.storage_space = connection_info.storage_space
+                        node.peer_port = connection_info.peer_port
 
                         SlaveNode.update_slave_node(node)
+                        self.repairs.resume()
                         print("Recovered node connected")
                     else:
                         if self.ready:  # during normal execution
@@ -1010,16 +2393,48 @@ class Master:
                         else:  # during the connection window
                             node.status = "connected"
                             node.address = connection_info.address
-                            node.socket = connection_info.socket
+                            node.connect(connection_info.socket)
                             # send id to the node
-                            node.socket.sendall(util.i_to_bytes(node.id))
-                            # get the storage space of the new node
-                            node.storage_space = util.i_from_bytes(node.socket.recv(util.bufsize))
+                            self.send_hello(node)
+                            # the storage space of the node came with its hello
+                            node.storage_space = connection_info.storage_space
+                            node.peer_port = connection_info.peer_port
 
                             SlaveNode.update_slave_node(node)
                             node.status = "restart"
                             print("Existing node connected")
 
+    def send_hello(self, node):
+        # send the node its id, along with the token its data connections will have to present
+        self.nodes_lock.acquire()
+        self.sessions.pop(node.token, None)
+        node.token = secrets.token_hex(16)
+        self.sessions[node.token] = node
+        self.nodes_lock.release()
+
+        node.connection.send_frame(util.op_hello, meta=util.s_to_bytes(str(node.id) + " " + node.token))
+
+    def attach_node_connection(self, connection_info, frame):
+        # the attach carries the node's id and the token it was given in its hello
+        attach = util.s_from_bytes(frame.meta).split(" ")
+
+        self.nodes_lock.acquire()
+        node = self.sessions.get(attach[-1])
+        self.nodes_lock.release()
+
+        if node is None or str(node.id) != attach[0]:
+            util.send_frame(connection_info.socket, util.op_attach, meta=util.s_to_bytes("unknown session"),
+                            status=util.status_fail)
+            connection_info.socket.close()
+            print("Data connection refused")
+        else:
+            util.send_frame(connection_info.socket, util.op_attach)
+            if self.engine is not None:
+                self.engine.attach(node, connection_info.socket)
+            else:
+                node.attach(connection_info.socket)
+            print("Data connection attached")
+
     def get_connected_node(self, id):
         matches = [x for x in self.nodes if x.id == id]
         if len(matches) != 1:
@@ -1028,8 +2443,8 @@ class Master:
             return matches[0]
 
     def setup_db(self):
-        # open the connection
-        conn = sqlite3.connect(util.database)
+        # get this thread's connection
+        conn = database.connect()
         c = conn.cursor()
         # Create the tables
         c.execute('''CREATE TABLE tbl_folder
@@ -1067,14 +2482,10 @@ class Master:
 
         c.execute('''CREATE UNIQUE INDEX ux_tbl_folder ON tbl_folder(parent_id, name)''')
 
-        # end
-        conn.commit()
-        conn.close()
+        # the rest of the schema comes from the upgrades
+        self.upgrade_db()
 
         # add the root directory
-        conn = sqlite3.connect(util.database)
-        c = conn.cursor()
-
         params = (1, 1, "root")
         c.execute('''INSERT INTO tbl_folder
                     (  id,
@@ -1085,103 +2496,218 @@ class Master:
                        ?,
                        ?)''', params)
 
-        conn.commit()
-        conn.close()
+    def upgrade_db(self):
+        """
+        Brings a database made by an older version up to the current schema, which is tracked by its user_version
+        :return:
+        """
+        # get this thread's connection
+        conn = database.connect()
+        c = conn.cursor()
+
+        c.execute("PRAGMA user_version")
+        version = c.fetchone()[0]
+
+        # each step is made in one transaction with the user_version it brings the database to, so a step which fails
+        # part way is rolled back and run again in full the next time
+        if version < 1:
+            with database.transaction():
+                # let the file parts be looked up without reading the whole table
+                c.execute('''CREATE INDEX IF NOT EXISTS ix_tbl_file_part_file_id ON tbl_file_part(file_id)''')
+                c.execute('''CREATE INDEX IF NOT EXISTS ix_tbl_file_part_node_id ON tbl_file_part(node_id)''')
+                c.execute('''CREATE INDEX IF NOT EXISTS ix_tbl_file_part_access_name ON tbl_file_part(access_name)''')
+                c.execute('''CREATE INDEX IF NOT EXISTS ix_tbl_file_part_status ON tbl_file_part(status)''')
+                c.execute('''CREATE INDEX IF NOT EXISTS ix_tbl_file_status ON tbl_file(status)''')
+                c.execute("PRAGMA user_version = 1")
+
+        if version < 2:
+            with database.transaction():
+                # keep the space used on each node with the node
+                c.execute('''ALTER TABLE tbl_slave_node ADD COLUMN used_space BIGINT NOT NULL DEFAULT 0''')
+                c.execute('''UPDATE tbl_slave_node SET used_space =
+                                (SELECT COALESCE(SUM(size), 0) FROM tbl_file_part WHERE node_id = tbl_slave_node.id)''')
+                c.execute("PRAGMA user_version = 2")
+
+        if version < 3:
+            with database.transaction():
+                # the parts waiting to be copied back up to the redundancy level, see RepairScheduler
+                c.execute('''CREATE TABLE IF NOT EXISTS tbl_repair
+                              (file_id INTEGER NOT NULL,
+                               sequence_order INTEGER NOT NULL,
+                               PRIMARY KEY(file_id, sequence_order))''')
+                c.execute("PRAGMA user_version = 3")
+
+        if version < 4:
+            with database.transaction():
+                # deleting a file used to leave the rows of its lost parts behind, still counted in their nodes' space
+                c.execute('''DELETE FROM tbl_file_part WHERE file_id NOT IN (SELECT id FROM tbl_file)''')
+                c.execute('''UPDATE tbl_slave_node SET used_space =
+                                (SELECT COALESCE(SUM(size), 0) FROM tbl_file_part WHERE node_id = tbl_slave_node.id)''')
+                c.execute("PRAGMA user_version = 4")
 
     def close(self):
         for node in self.nodes:
-            node.socket_lock.acquire()
-            node.socket.sendall(util.s_to_bytes("CLOSE"))
-            node.socket_lock.release()
+            node.connection.send_frame(util.op_close)
         self.execute = False
+        PartCache.clear()
 
     def upload_file(self, name, bytes, folder_id=1):
-        # find which nodes have enough space to be used to store the file
-        file_size = len(bytes)
-        redundant_level = util.redundant_level
-        nodes = []
-        if len(self.nodes) == 1:
-            redundant_level = 1
-
-        while redundant_level > 0:
-            enough_space = False
-            nodes = [node for node in self.nodes]
-            while len(nodes) > 0:
-                split_size = math.ceil(file_size / len(nodes)) * redundant_level
-                all_good = True
-                for node in nodes:
-                    if self.get_node_space_available(node) < split_size:
-                        all_good = False
-                        nodes.remove(node)
+        # parts are sent as views into the given bytes so nothing is copied, and with a write quorum some copies
+        # may still be reading them after this returns, so they mustn't be changed
+        view = memoryview(bytes)
+        return self.upload_parts(name, len(bytes), lambda offset, length: [view[offset:offset + length]], folder_id)
+
+    def upload_stream(self, name, stream, size=None, folder_id=1):
+        """
+        Uploads the contents of the given file object or iterator of byte chunks. At most util.transfer_bufsize
+        bytes are held in memory per part being sent, no matter how large the file is. Regular files are read at
+        each part's offset so the parts can still be sent in parallel, anything else is read through once in order.
+        :param name:
+        :param stream:
+        :param size: the number of bytes to read, required unless the stream is a regular file
+        :param folder_id:
+        :return:
+        """
+        fd = util.stream_fileno(stream)
+        if size is None:
+            size = util.stream_size(stream)
+
+        if fd is not None:
+            start = stream.tell()
+            # copies finishing in the background read from their own handle, so the caller can close the stream
+            fd = os.dup(fd)
+            return self.upload_parts(name, size,
+                                     lambda offset, length: util.pread_chunks(fd, start + offset, length),
+                                     folder_id, release=lambda: os.close(fd))
+        else:
+            return self.upload_sequential(name, size, util.ChunkReader(stream), folder_id)
+
+    def get_upload_nodes(self, file_size):
+        """
+        Picks the nodes a file of file_size bytes is split among and the redundant level it gets, and reserves the
+        space it will take on each of them. The reservation must be given to SpaceLedger.release once the upload
+        is done, whether or not it worked
+        :param file_size:
+        :return: nodes, redundant_level, reservation
+        """
+        # the space is checked and reserved in one go so another upload can't take it in between
+        SpaceLedger.lock.acquire()
+        try:
+            # find which nodes have enough space to be used to store the file
+            redundant_level = util.redundant_level
+            nodes = []
+            if len(self.nodes) == 1:
+                redundant_level = 1
+
+            while redundant_level > 0:
+                enough_space = False
+                nodes = [node for node in self.nodes]
+                while len(nodes) > 0:
+                    split_size = math.ceil(file_size / len(nodes)) * redundant_level
+                    all_good = True
+                    for node in nodes:
+                        if self.get_node_space_available(node) < split_size:
+                            all_good = False
+                            nodes.remove(node)
+                            break
+                    if all_good:
+                        enough_space = True
                         break
-                if all_good:
-                    enough_space = True
+                if enough_space:
                     break
-            if enough_space:
-                break
-            else:
-                redundant_level -= 1
+                else:
+                    redundant_level -= 1
+
+            if redundant_level == 0:
+                raise Exception("Not enough space available")
+            elif len(nodes) == 1:
+                redundant_level = 1
 
-        if redundant_level == 0:
-            raise Exception("Not enough space available")
-        elif len(nodes) == 1:
-            redundant_level = 1
+            # each node gets one part for every redundant level
+            reservation = {}
+            for node in nodes:
+                reservation[node.id] = math.ceil(file_size / len(nodes)) * redundant_level
+            SpaceLedger.reserve(reservation)
 
+        finally:
+            SpaceLedger.lock.release()
+
+        return nodes, redundant_level, reservation
+
+    def create_file(self, name, file_size, folder_id, redundant_level):
         # create the new file object
         file_obj = File()
         file_obj.folder_id = folder_id
         file_obj.upload_date = datetime.datetime.utcnow()
         file_obj.name = name
-        file_obj.size = len(bytes)
+        file_obj.size = file_size
         if redundant_level == 1:
             file_obj.status = "danger"
 
         File.insert_file(file_obj)
 
-        # split the file into parts
-        num_splits = len(nodes)
-        if num_splits > 0:
-            split_size = math.ceil(file_obj.size / num_splits)
-            # make a copy for each redundant_level
-            for i in range(redundant_level):
-                index = 0
-                array_index = 0
-                parts = [None] * num_splits
-                part_bytes = [None] * num_splits
-                while index < num_splits:
-                    part_bytes[index] = bytes[array_index:array_index + split_size]
-
-                    part = FilePart()
-                    part.node_id = nodes[index].id
-                    part.file_id = file_obj.id
-                    part.sequence_order = index
-                    part.access_name = str(file_obj.id) + "_" + str(index)
-                    part.size = len(part_bytes[index])
-
-                    parts[index] = part
-
-                    index += 1
-                    array_index += split_size
-
-                # send each part to the slave nodes
-                self.busy = True
-                msgs = [None] * num_splits
-                threads = [None] * num_splits
-                index = 0
-                while index < num_splits:
-                    t = threading.Thread(target=self.upload_part,
-                                         args=(nodes[index],
-                                               parts[index].access_name,
-                                               part_bytes[index],
-                                               msgs,
-                                               index))
-                    threads[index] = t
-                    t.start()
-                    index += 1
-                for t in threads:
-                    t.join()
-
-                self.busy = False
+        return file_obj
+
+    def create_parts(self, file_obj, nodes, split_size):
+        parts = [None] * len(nodes)
+        for index in range(len(nodes)):
+            part = FilePart()
+            part.node_id = nodes[index].id
+            part.file_id = file_obj.id
+            part.sequence_order = index
+            part.access_name = str(file_obj.id) + "_" + str(index)
+            part.size = max(0, min(split_size, file_obj.size - index * split_size))
+
+            parts[index] = part
+
+        return parts
+
+    def upload_parts(self, name, file_size, get_chunks, folder_id=1, release=None):
+        """
+        Splits a file of file_size bytes among the nodes and sends each part. get_chunks(offset, length) must
+        return an iterable of the chunks making up that range of the file, and may be called from any thread
+        :param name:
+        :param file_size:
+        :param get_chunks:
+        :param folder_id:
+        :param release: called once nothing will call get_chunks again, which may be after this returns
+        :return:
+        """
+        try:
+            nodes, redundant_level, reservation = self.get_upload_nodes(file_size)
+        except Exception:
+            if release is not None:
+                release()
+            raise
+
+        try:
+            file_obj = self.create_file(name, file_size, folder_id, redundant_level)
+
+            # split the file into parts
+            num_splits = len(nodes)
+            if num_splits > 0:
+                split_size = math.ceil(file_obj.size / num_splits)
+                # the copies of each part, one for each redundant_level
+                copies = self.place_copies(file_obj, nodes, redundant_level, split_size)
+
+                remaining = list(range(num_splits))  # the parts whose copies are all sent by the master
+                if util.upload_mode == "chain":
+                    # each part goes once to its first node, which passes it along to the rest
+                    chained = [index for index in remaining if self.can_chain(copies[index])]
+                    jobs = [(copies[index][0][0], self.chain_meta(copies[index]),
+                             get_chunks(index * split_size, copies[index][0][1].size)) for index in chained]
+                    msgs = self.send_parts(jobs)
+                    for index, msg in zip(chained, msgs):
+                        if msg is None:
+                            remaining.remove(index)
+                        else:
+                            print(msg)
+
+                # every copy of every part is sent at once, but only the write quorum of each is waited for
+                started = [(self.start_upload(node, part.access_name, get_chunks(index * split_size, part.size)),
+                            node, part) for index in remaining for node, part in copies[index]]
+                msgs = self.wait_for_quorum(started, redundant_level)
+
                 # check for any errors
                 errors = [x for x in msgs if x is not None]
                 if len(errors) > 0:
@@ -1190,181 +2716,741 @@ class Master:
                         errmsg += error
                     File.delete_file(file_obj)
                     raise Exception("Error sending file: " + errmsg)
-                else:
-                    for part in parts:
-                        FilePart.insert_file_part(part)
 
-                # rotate all of the nodes so we don't put the same file parts in each
-                rotate_nodes = [None] * num_splits
-                for i_node in range(num_splits):
-                    rotate_nodes[i_node] = nodes[(i_node + 1) % num_splits]
-                nodes = rotate_nodes
+                # the copies which aren't written yet are finished in the background, holding on to their space
+                unwritten = [(future, node, part) for future, node, part in started
+                             if not future.done() or future.result() is not None]
+                unwritten_parts = set([id(part) for future, node, part in unwritten])
+                FilePart.insert_file_parts([part for part_copies in copies for node, part in part_copies
+                                            if id(part) not in unwritten_parts])
+                if len(unwritten) > 0:
+                    held = {}
+                    for future, node, part in unwritten:
+                        held[node.id] = held.get(node.id, 0) + part.size
+                        reservation[node.id] -= part.size
+                    if file_obj.status is None:
+                        file_obj.status = "danger"
+                        File.update_file(file_obj)
+                    self.finish_copies(file_obj, unwritten, held, release)
+                    release = None
+
+                # return the file_obj if everything was successfully completed
+                return file_obj
+
+            else:
+                File.delete_file(file_obj)
+                raise Exception("Error: no connected nodes")
+
+            return None
+
+        finally:
+            SpaceLedger.release(reservation)
+            if release is not None:
+                release()
+
+    def upload_sequential(self, name, file_size, reader, folder_id=1):
+        """
+        Like upload_parts, but for sources which can only be read once from start to finish. Each part is read a
+        chunk at a time and every chunk is sent to all of the part's copies before the next one is read.
+        :param name:
+        :param file_size:
+        :param reader:
+        :param folder_id:
+        :return:
+        """
+        nodes, redundant_level, reservation = self.get_upload_nodes(file_size)
+        try:
+            file_obj = self.create_file(name, file_size, folder_id, redundant_level)
+
+            num_splits = len(nodes)
+            split_size = math.ceil(file_obj.size / num_splits)
+
+            # work out where every copy goes up front
+            copies = self.place_copies(file_obj, nodes, redundant_level, split_size)
+
+            try:
+                for index in range(num_splits):
+                    size = copies[index][0][1].size
+
+                    msgs = self.upload_copies(copies[index], util.read_chunks(reader, size))
+
+                    errors = [x for x in msgs if x is not None]
+                    if len(errors) > 0:
+                        raise Exception("Error sending file: " + "".join(errors))
+
+            except Exception:
+                File.delete_file(file_obj)
+                raise
+
+            FilePart.insert_file_parts([part for part_copies in copies for node, part in part_copies])
 
-            # return the file_obj if everything was successfully completed
             return file_obj
 
-        else:
-            File.delete_file(file_obj)
-            raise Exception("Error: no connected nodes")
+        finally:
+            SpaceLedger.release(reservation)
+
+    def place_copies(self, file_obj, nodes, redundant_level, split_size):
+        """
+        Works out where every copy of every part of the file goes, rotating the nodes for each redundant level so
+        the same node never gets two copies of one part
+        :param file_obj:
+        :param nodes:
+        :param redundant_level:
+        :param split_size:
+        :return: a list with the (node, part) copies of each part, in sequence order
+        """
+        num_splits = len(nodes)
+        copies = [[] for index in range(num_splits)]
+        for i in range(redundant_level):
+            parts = self.create_parts(file_obj, nodes, split_size)
+            for index in range(num_splits):
+                copies[index].append((nodes[index], parts[index]))
+
+            # rotate all of the nodes so we don't put the same file parts in each
+            nodes = [nodes[(i_node + 1) % num_splits] for i_node in range(num_splits)]
+
+        return copies
+
+    def send_parts(self, jobs):
+        # sends every (node, meta, chunks) upload at once, returning an error message (or None) for each
+        if self.engine is not None:
+            return self.engine.run(self.engine.upload_parts(jobs))
+
+        msgs = [None] * len(jobs)
+        self.foreground.run_all(self.upload_part_chunks, [job + (msgs, index) for index, job in enumerate(jobs)])
+        return msgs
+
+    def start_upload(self, node, name, chunks):
+        # starts sending a part without waiting for it, returning a Future for its error message (or None)
+        if self.engine is not None:
+            return self.engine.submit(self.engine.try_upload_part(node, name, chunks))
+
+        return self.foreground.submit(self.try_upload_part, node, name, chunks)
+
+    def try_upload_part(self, node, name, chunks):
+        errors = [None]
+        self.upload_part_chunks(node, name, chunks, errors, 0)
+        return errors[0]
+
+    def wait_for_quorum(self, started, redundant_level):
+        """
+        Waits until util.write_quorum copies of each part are written, or all of them when the quorum is 0. If a part
+        can't get that many, every copy is waited for and the error messages of the ones which failed are returned
+        :param started: a list of (future, node, part) for each copy being sent
+        :param redundant_level:
+        :return: the error messages of the copies which failed, if the quorum couldn't be reached
+        """
+        quorum = redundant_level
+        if 0 < util.write_quorum < redundant_level:
+            quorum = util.write_quorum
+
+        needed = {}  # key: sequence_order  value: copies still to be written before the part has its quorum
+        spare = {}  # key: sequence_order  value: copies which can still fail without losing the quorum
+        parts = {}  # key: future  value: part
+        for future, node, part in started:
+            needed[part.sequence_order] = quorum
+            spare[part.sequence_order] = spare.get(part.sequence_order, -quorum) + 1
+            parts[future] = part
+
+        pending = set(parts.keys())
+        short = False
+        while len(pending) > 0 and not short and any([count > 0 for count in needed.values()]):
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                part = parts[future]
+                if future.result() is None:
+                    needed[part.sequence_order] -= 1
+                else:
+                    spare[part.sequence_order] -= 1
+                    short = short or spare[part.sequence_order] < 0
+
+        if not short:
+            return []
+
+        # the upload has failed, let the rest of the copies finish before it's cleaned up
+        concurrent.futures.wait(pending)
+        return [future.result() for future in parts.keys() if future.result() is not None]
+
+    def finish_copies(self, file_obj, unwritten, held, release):
+        """
+        Records the copies of an upload which weren't written when it returned once they're all done. Nothing waits
+        for them, so no worker is held up: each copy counts down as it finishes, and the last one queues
+        record_copies on a background worker
+        :param file_obj:
+        :param unwritten: a list of (future, node, part) for each copy still being sent
+        :param held: the space reserved for the copies, released once they're done
+        :param release: the release given to upload_parts
+        :return:
+        """
+        left = [len(unwritten)]
+        left_lock = threading.Lock()
+
+        def copy_done(future):
+            with left_lock:
+                left[0] -= 1
+                if left[0] > 0:
+                    return
+            self.background.submit(self.record_copies, file_obj, unwritten, held, release)
+
+        for future, node, part in unwritten:
+            future.add_done_callback(copy_done)
+
+    def record_copies(self, file_obj, unwritten, held, release):
+        """
+        Records the copies of an upload which made it once they're all done, see finish_copies. Copies which failed
+        are left to the repair scheduler. This runs on a background worker, so anything which goes wrong is printed
+        rather than left in the worker's future
+        :param file_obj:
+        :param unwritten:
+        :param held:
+        :param release:
+        :return:
+        """
+        try:
+            try:
+                if release is not None:
+                    release()
+                new_parts = []
+                for future, node, part in unwritten:
+                    if future.result() is None:
+                        new_parts.append(part)
+                    else:
+                        print("Copy of part " + str(part.sequence_order) + " of file " + str(part.file_id) +
+                              " failed: " + future.result())
+
+                if File.get_file(file_obj.id) is None:
+                    # the file was deleted before its copies were all written
+                    self.delete_orphans([(node, part) for future, node, part in unwritten
+                                         if future.result() is None])
+                    return
+                FilePart.insert_file_parts(new_parts)
+
+            finally:
+                SpaceLedger.release(held)
+
+            # the parts still short of copies are repaired like any other
+            copies = {}  # key: sequence_order  value: copies written
+            for part in FilePart.get_file_parts_by_file(file_obj.id):
+                copies[part.sequence_order] = copies.get(part.sequence_order, 0) + 1
+            repairs = set([part.sequence_order for future, node, part in unwritten if future.result() is not None])
+            self.repairs.schedule([(file_obj.id, sequence_order, copies.get(sequence_order, 0), file_obj.size)
+                                   for sequence_order in repairs])
+            RepairScheduler.update_file_status(File.get_file(file_obj.id))
+
+        except Exception as e:
+            print("Finishing the copies of file " + str(file_obj.id) + " failed: " + str(e))
+
+    def delete_orphans(self, copies):
+        # deletes the (node, part) copies of a file which no longer exists, skipping the nodes which are gone
+        connected = dict([(node.id, node) for node in self.nodes])
+        for node, part in copies:
+            node = connected.get(part.node_id)
+            if node is None:
+                print("Part " + part.access_name + " left on node " + str(part.node_id) + ", which isn't connected")
+                continue
+            errors = [None]
+            self.delete_part(node, part.access_name, errors, 0)
+            if errors[0] is not None:
+                print(errors[0])
+
+    def can_chain(self, copies):
+        # every node after the first has to take the part from the one before it
+        return len(copies) > 1 and all([node.peer_port is not None for node, part in copies[1:]])
+
+    def chain_meta(self, copies):
+        """
+        Returns the meta of an upload to the first of the copies which has it passed along to the others. After the
+        name comes the host, peer port and a grant for each of the other nodes in turn
+        :param copies:
+        :return:
+        """
+        name = copies[0][1].access_name
+        fields = [name]
+        for node, part in copies[1:]:
+            fields += [node.address[0], str(node.peer_port), util.make_grant(node.token, name)]
 
-        return None
+        return " ".join(fields)
+
+    def upload_copies(self, copies, chunks):
+        """
+        Sends each chunk to every (node, part) pair in copies, returning an error message (or None) for each
+        :param copies:
+        :param chunks:
+        :return:
+        """
+        msgs = [None] * len(copies)
+        requests = [None] * len(copies)
+        connections = [node.checkout() for node, part in copies]
+        try:
+            return self.send_copies(copies, connections, requests, msgs, chunks)
+
+        finally:
+            for index, (node, part) in enumerate(copies):
+                node.checkin(connections[index])
+
+    def send_copies(self, copies, connections, requests, msgs, chunks):
+        for index, (node, part) in enumerate(copies):
+            try:
+                requests[index] = connections[index].new_request()
+                connections[index].send_frame(util.op_upload, requests[index].request_id,
+                                              util.s_to_bytes(part.access_name), flags=util.flag_more)
+            except socket.error as e:
+                msgs[index] = str(e)
+
+        chunks = iter(chunks)
+        status = util.status_ok
+        error = None
+        while True:
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                break
+            except Exception as e:
+                # end the uploads as aborted so the slaves throw away what they got
+                chunk = b""
+                status = util.status_fail
+                error = e
+
+            for index, (node, part) in enumerate(copies):
+                if msgs[index] is None:
+                    try:
+                        view = memoryview(chunk)
+                        for pos in range(0, max(len(view), 1), util.transfer_bufsize):
+                            flags = util.flag_more if error is None else 0
+                            connections[index].send_frame(util.op_data, requests[index].request_id,
+                                                          payload=view[pos:pos + util.transfer_bufsize],
+                                                          status=status, flags=flags)
+                    except socket.error as e:
+                        msgs[index] = str(e)
+
+            if error is not None:
+                break
+
+        for index, (node, part) in enumerate(copies):
+            if msgs[index] is None and error is None:
+                try:
+                    connections[index].send_frame(util.op_data, requests[index].request_id)
+                except socket.error as e:
+                    msgs[index] = str(e)
+
+        for index, (node, part) in enumerate(copies):
+            if msgs[index] is None:
+                try:
+                    connections[index].check_response(requests[index], "upload")
+                except socket.error as e:
+                    msgs[index] = str(e)
+            elif requests[index] is not None:
+                connections[index].cancel(requests[index])
+
+        if error is not None:
+            raise error
+
+        return msgs
 
     def upload_part(self, node, name, bytes, errors, index):
-        node.socket_lock.acquire()
+        self.upload_part_chunks(node, name, [bytes], errors, index)
+
+    def upload_part_chunks(self, node, name, chunks, errors, index):
+        connection = node.checkout()
         try:
-            # send command
-            node.socket.sendall(util.s_to_bytes("UPLOAD"))
-            ready = select.select([node.socket], [], [], util.slave_response_timeout)
-            if ready[0]:
-                response = util.s_from_bytes(node.socket.recv(util.bufsize))
-            else:
-                response = "FAIL"
-            if response != "OK":
-                raise socket.error("upload time out")
-            # send the name
-            node.socket.sendall(util.s_to_bytes(name))
-            ready = select.select([node.socket], [], [], util.slave_response_timeout)
-            if ready[0]:
-                response = util.s_from_bytes(node.socket.recv(util.bufsize))
-            else:
-                response = "FAIL"
-            if response != "OK":
-                raise socket.error("upload time out")
-            # send the size of the file part
-            node.socket.sendall(util.i_to_bytes(len(bytes)))
-            ready = select.select([node.socket], [], [], util.slave_response_timeout)
-            if ready[0]:
-                response = util.s_from_bytes(node.socket.recv(util.bufsize))
-            else:
-                response = "FAIL"
-            if response != "OK":
-                raise socket.error("upload time out")
-            # send the file part
-            node.socket.sendall(bytes)
-            ready = select.select([node.socket], [], [], util.slave_response_timeout)
-            if ready[0]:
-                response = util.s_from_bytes(node.socket.recv(util.bufsize))
-            else:
-                response = "FAIL"
-            if response != "OK":
-                raise socket.error("upload time out")
+            # send the name and file part in one go
+            request = connection.new_request()
+            try:
+                connection.send_message(util.op_upload, request.request_id, util.s_to_bytes(name), chunks)
+            except socket.error:
+                # this includes uploads aborted because reading the chunks failed, no need to wait for the answer
+                connection.cancel(request)
+                raise
+            connection.check_response(request, "upload")
 
         except socket.error as e:
             errors[index] = str(e)
 
         finally:
-            node.socket_lock.release()
+            node.checkin(connection)
 
-    def download_file(self, id):
+    def replicate_part(self, source, name, target, errors, index):
+        """
+        Has source send its part with the given name straight to target, with a grant for target that can only be
+        used once for that part. The source reports back as each frame goes out, so the time out is between frames
+        :param source:
+        :param name:
+        :param target:
+        :param errors:
+        :param index:
+        :return:
+        """
+        grant = util.make_grant(target.token, name)
+        meta = " ".join([name, target.address[0], str(target.peer_port), grant])
+
+        connection = source.checkout()
         try:
-            file_obj = File.get_file(id)
-            if file_obj is None:
-                raise Exception("The requested file does not exist.")
-            if file_obj.status == "lost":
-                raise Exception("The selected file is currently unavailable for download.")
+            request = connection.new_request()
+            connection.send_frame(util.op_replicate, request.request_id, util.s_to_bytes(meta))
+            # the source may take up to its connect time out to reach the target
+            connection.check_response(request, "replicate", util.slave_connect_timeout + util.slave_response_timeout)
 
-            # get all the file parts
-            file_parts = [x for x in FilePart.get_file_parts() if x.file_id == file_obj.id]
-            num_parts = max(file_parts,
-                            key=lambda var: var.sequence_order)\
-                .sequence_order + 1  # the number of "unique" file parts
+        except socket.error as e:
+            errors[index] = str(e)
 
-            node_dict = {}  # key: node_id  value: node
-            for node in self.nodes:
-                node_dict[node.id] = node
+        finally:
+            source.checkin(connection)
 
-            part_found = [False] * num_parts  # has the part with the given sequence_order been found?
-            part_dict = {}  # key: part_sequence_order  value: part
-            part_on_node_dict = {}  # key: part_sequence_order  value: node that stores it
-            for part in file_parts:
-                if part.node_id in node_dict:
-                    part_found[part.sequence_order] = True
-                    if part.sequence_order not in part_on_node_dict:
-                        part_on_node_dict[part.sequence_order] = node_dict[part.node_id]
-                        part_dict[part.sequence_order] = part
-
-            # check if all file parts are accounted for
-            if len([x for x in part_found if x is False]) > 0:
-                raise Exception("Not all file parts are available from the set of nodes currently connected")
-
-            # get the part from each node
-            self.busy = True
-            rtnVal = [None] * num_parts
-            threads = [None] * num_parts
-            index = 0
-            while index < num_parts:
-                t = threading.Thread(target=self.download_part,
-                                     args=(part_on_node_dict[index],
-                                           part_dict[index].access_name,
-                                           rtnVal,
-                                           index))
-                threads[index] = t
-                t.start()
-                index += 1
-            for t in threads:
-                t.join()
-
-            self.busy = False
-            # check for any errors
-            part_contents = [x for x in rtnVal if isinstance(x, bytearray)]
-            if len(part_contents) < num_parts:
-                msg = ""
-                errors = [x for x in rtnVal if isinstance(x, str)]
-                for error in errors:
-                    msg += error
-                raise Exception("Error receiving file: " + msg)
-            else:
-                file_contents = bytearray()
-                for part_content in part_contents:
-                    file_contents += part_content
+    def download_file(self, id):
+        try:
+            file_obj = self.get_download_file(id)
 
-                return file_contents
+            # each part is written straight into its place in the final buffer
+            file_contents = bytearray(file_obj.size)
+            view = memoryview(file_contents)
+            invalidations = PartCache.begin_fill()
+            fetched = self.download_parts(file_obj, lambda offset: util.ViewWriter(view, offset))
+
+            # the parts which came from the slaves are copied out of the result into the cache
+            PartCache.fill(view, fetched, invalidations)
+
+            return file_contents
 
         except Exception as e:
             print(str(e))
 
             return None
 
-    def download_part(self, node, name, rtn_val, index):
-        node.socket_lock.acquire()
+    def read_range(self, id, offset, length):
+        """
+        Returns length bytes of the file with the given id starting at offset, reading only those bytes from the
+        parts which hold them. A range running past the end of the file is cut short
+        :param id:
+        :param offset:
+        :param length:
+        :return:
+        """
+        file_obj = self.get_download_file(id)
+        if offset < 0 or length < 0:
+            raise Exception("Invalid range")
+        length = max(0, min(length, file_obj.size - offset))
+
+        contents = bytearray(length)
+        if length > 0:
+            view = memoryview(contents)
+            self.download_parts(file_obj, lambda start: util.ViewWriter(view, start), offset, length)
+
+        return contents
+
+    def download_file_to(self, id, path):
+        """
+        Downloads the file with the given id into the file at path. Each part is written to its offset in the
+        output file as it is received, so only util.transfer_bufsize bytes per part are ever held in memory.
+        :param id:
+        :param path:
+        :return:
+        """
+        file_obj = self.get_download_file(id)
+
+        file = open(path, mode='wb')
+        file.truncate(file_obj.size)
+        file.close()
+
         try:
-            # send command
-            node.socket.sendall(util.s_to_bytes("DOWNLOAD"))
-            ready = select.select([node.socket], [], [], util.slave_response_timeout)
-            if ready[0]:
-                response = util.s_from_bytes(node.socket.recv(util.bufsize))
-            else:
-                response = "FAIL"
-            if response != "OK":
-                raise socket.error("download time out")
-            # send the name
-            node.socket.sendall(util.s_to_bytes(name))
-            ready = select.select([node.socket], [], [], util.slave_response_timeout)
-            if ready[0]:
-                response = util.i_from_bytes(node.socket.recv(util.bufsize))
-            else:
-                response = "FAIL"
-            if response == "FAIL":
-                raise socket.error("upload time out")
-            file_size = response
-            # send the size of the file part
-            node.socket.sendall(util.s_to_bytes("SEND"))
-
-            # get the file in "chunks" of bufsize
-            bytes = bytearray()
-            num_got = 0
-            while num_got < file_size:
-                chunk = node.socket.recv(util.bufsize)
-                bytes += chunk
-                num_got += len(chunk)
-
-            rtn_val[index] = bytes
+            # every part gets its own handle so they can all write at once
+            def open_writer(offset):
+                writer = open(path, mode='r+b')
+                writer.seek(offset)
+                return writer
+
+            self.download_parts(file_obj, open_writer)
+
+        except Exception:
+            os.remove(path)
+            raise
+
+        return file_obj
+
+    def iter_file(self, id):
+        """
+        Generator yielding the contents of the file with the given id in order, a range of a FileReader at a time
+        :param id:
+        :return:
+        """
+        with self.open_file(id) as reader:
+            yield from reader
+
+    def open_file(self, id, window=None):
+        """
+        Returns a FileReader of the file with the given id, which keeps window ranges of the file downloading ahead
+        of the caller, util.readahead_window if it isn't given
+        :param id:
+        :param window:
+        :return:
+        """
+        return FileReader(self, self.get_download_file(id), window)
+
+    def start_read(self, copies, writer, offset, length):
+        # starts downloading length bytes of a part from offset into writer without waiting, returning a Future for
+        # its error message (or None)
+        if self.engine is not None:
+            return self.engine.submit(self.engine.try_download_replicas_to(copies, writer, offset, length))
+
+        return self.foreground.submit(self.try_download_replicas_to, copies, writer, offset, length)
+
+    def try_download_replicas_to(self, copies, writer, offset, length):
+        errors = [None]
+        self.download_replicas_to(copies, writer, offset, length, errors, 0)
+        return errors[0]
+
+    def iter_part(self, node, name):
+        """
+        Generator yielding the contents of the part with the given name on node, a chunk at a time
+        :param node:
+        :param name:
+        :return:
+        """
+        # at most util.stream_window chunks are held while waiting for the caller to take them. The connection's
+        # reader only waits util.stream_stall_timeout for room, if the caller falls further behind than that the
+        # download fails so the other requests on the connection aren't held up
+        chunks = queue.Queue(util.stream_window)
+        writer = util.QueueWriter(chunks, util.stream_stall_timeout)
+        connection = node.checkout()
+        request = connection.new_request(lambda frame: writer)
+        try:
+            connection.send_frame(util.op_download, request.request_id, util.s_to_bytes(name))
+            while True:
+                try:
+                    chunk = chunks.get(timeout=util.wait_interval)
+                except queue.Empty:
+                    if request.error is not None:
+                        raise socket.error(request.error)
+                    if request.done.is_set() and chunks.empty():
+                        break
+                    if connection.timed_out(request, util.slave_response_timeout):
+                        raise socket.error("download time out")
+                    continue
+                if request.error is not None:
+                    raise socket.error(request.error)
+                yield chunk
+            connection.check_response(request, "download")
+
+        finally:
+            # if we were stopped part way through, stop the download and let go of the reader in case it's
+            # waiting for room in the queue
+            writer.closed = True
+            connection.cancel(request)
+            while not chunks.empty():
+                chunks.get()
+            node.checkin(connection)
+
+    def get_download_file(self, id):
+        file_obj = File.get_file(id)
+        if file_obj is None:
+            raise Exception("The requested file does not exist.")
+        if file_obj.status == "lost":
+            raise Exception("The selected file is currently unavailable for download.")
+
+        return file_obj
+
+    def get_download_replicas(self, file_obj):
+        """
+        Returns the (part, node) copies on connected nodes of each sequence_order of the file, in order. The copies
+        of each part are ranked by NodeStats.estimate, best first, counting the parts of the file already given to
+        each node so a file isn't all read from the one fastest node
+        :param file_obj:
+        :return:
+        """
+        # get all the file parts
+        file_parts = FilePart.get_file_parts_by_file(file_obj.id)
+        num_parts = max(file_parts,
+                        key=lambda var: var.sequence_order)\
+            .sequence_order + 1  # the number of "unique" file parts
+
+        node_dict = {}  # key: node_id  value: node
+        for node in self.nodes:
+            node_dict[node.id] = node
+
+        replicas = [[] for index in range(num_parts)]  # the copies of the part with each sequence_order
+        for part in file_parts:
+            if part.node_id in node_dict:
+                replicas[part.sequence_order].append((part, node_dict[part.node_id]))
+
+        # check if all file parts are accounted for
+        if len([x for x in replicas if len(x) == 0]) > 0:
+            raise Exception("Not all file parts are available from the set of nodes currently connected")
+
+        planned = {}  # key: node_id  value: parts of the file it's the best copy of so far
+        for copies in replicas:
+            copies.sort(key=lambda copy: NodeStats.estimate(copy[1].id, copy[0].size, planned.get(copy[1].id, 0)))
+            planned[copies[0][1].id] = planned.get(copies[0][1].id, 0) + 1
+
+        return replicas
+
+    def download_parts(self, file_obj, open_writer, offset=0, length=None):
+        """
+        Downloads every part of the file in parallel. open_writer(offset) is called once per part (or stripe of one)
+        and must return a file-like object which its contents are written to, starting at that offset of the file.
+        When a length is given only the length bytes starting at offset are read, from the parts which hold them,
+        and the offsets given to open_writer are counted from offset instead
+        :param file_obj:
+        :param open_writer:
+        :param offset:
+        :param length:
+        :return: a list of (access_name, offset, size) of the parts read whole from the slaves, not the cache
+        """
+        replicas = self.get_download_replicas(file_obj)
+        end = file_obj.size if length is None else offset + length
+
+        # get each part from its best copy, hedged with the others, or in stripes from all of its copies at once.
+        # Parts in the PartCache are written straight out
+        jobs = []
+        fetched = []
+        part_start = 0
+        for copies in replicas:
+            name = copies[0][0].access_name
+            size = copies[0][0].size
+            first = max(offset, part_start) - part_start  # the range of the part which is wanted
+            last = min(end, part_start + size) - part_start
+            cached = None
+            if first < last and PartCache.cacheable(size):
+                cached = PartCache.get(name)
+            if cached is not None:
+                writer = open_writer(part_start + first - offset)
+                try:
+                    writer.write(memoryview(cached)[first:last])
+                finally:
+                    writer.close()
+            elif first < last:
+                wanted = None if first == 0 and last == size else last - first
+                if wanted is None:
+                    fetched.append((name, part_start, size))
+                for start, count, stripe_copies in self.get_stripes(copies, first, wanted):
+                    jobs.append((stripe_copies, open_writer(part_start + start - offset), start, count))
+            part_start += size
+        if self.engine is not None:
+            msgs = self.engine.run(self.engine.download_replicas(jobs))
+        else:
+            msgs = [None] * len(jobs)
+            self.foreground.run_all(self.download_replicas_to,
+                                    [job + (msgs, index) for index, job in enumerate(jobs)])
+
+        # check for any errors
+        errors = [x for x in msgs if x is not None]
+        if len(errors) > 0:
+            raise Exception("Error receiving file: " + "".join(errors))
+
+        return fetched
+
+    def get_stripes(self, copies, offset=0, length=None):
+        """
+        Splits a part, or length bytes of it starting at offset, into a stripe for each of its copies when it's big
+        enough, util.stripe_size at the least, so it can be read from all of them at once
+        :param copies: the (part, node) copies of the part, best first
+        :param offset:
+        :param length: the bytes wanted, or None for the whole part
+        :return: a list of (offset, length, copies) for each stripe, the copies rotated so each stripe is first
+                 asked of a different node. The length is None when the part is read whole
+        """
+        size = copies[0][0].size if length is None else length
+        num_stripes = len(copies)
+        if util.stripe_size > 0:
+            num_stripes = min(num_stripes, size // util.stripe_size)
+        if util.stripe_size <= 0 or num_stripes < 2:
+            return [(offset, length, copies)]
+
+        stripe_len = math.ceil(size / num_stripes)
+        return [(offset + start, min(stripe_len, size - start), copies[i:] + copies[:i])
+                for i, start in enumerate(range(0, size, stripe_len))]
+
+    def download_replicas_to(self, copies, writer, offset, length, errors, index):
+        """
+        Downloads a part into writer from the first of its copies. If that node hasn't started answering after
+        NodeStats.hedge_delay(), the next copy is asked as well, and whichever starts answering first is written out
+        while the other is cancelled. A copy which fails before answering is passed over for the next one
+        :param copies: the (part, node) copies of the part, best first
+        :param writer:
+        :param offset: where in the part to start
+        :param length: the bytes to read, or None for the whole part
+        :param errors:
+        :param index:
+        :return:
+        """
+        race = util.DownloadRace(writer, threading.Event())
+        started = []  # [node, connection, request, start time] of each copy asked
+        live = []  # the ones of those which haven't failed
+        error = None
+        hedged = False
+        hedge_at = 0.0
+        try:
+            while race.winner is None:
+                now = time.monotonic()
+                for attempt in list(live):
+                    node, connection, request, start = attempt
+                    if race.winner is attempt:
+                        continue
+                    if request.done.is_set() or connection.timed_out(request, util.slave_response_timeout):
+                        # it failed without answering
+                        live.remove(attempt)
+                        if not request.done.is_set():
+                            NodeStats.record_latency(node.id, now - start)
+                        connection.cancel(request)
+                        if request.error is not None:
+                            error = request.error
+                        elif request.frame is not None:
+                            error = "download failed: " + util.s_from_bytes(request.frame.meta)
+
+                if race.winner is not None:
+                    break
+                if len(live) == 0 or (len(live) == 1 and not hedged and now >= hedge_at):
+                    if len(started) == len(copies):
+                        if len(live) == 0:
+                            raise socket.error(error or "download time out")
+                    else:
+                        hedged = len(live) > 0
+                        part, node = copies[len(started)]
+                        NodeStats.begin(node.id)
+                        attempt = [node, None, None, now]
+                        started.append(attempt)
+                        try:
+                            attempt[1] = node.checkout()
+                            attempt[2] = attempt[1].new_request(race.claimer(attempt))
+                            attempt[1].send_frame(util.op_download, attempt[2].request_id,
+                                                  util.download_meta(part.access_name, offset, length))
+                            live.append(attempt)
+                            hedge_at = now + NodeStats.hedge_delay()
+                        except socket.error as e:
+                            error = str(e)
+                            continue
+
+                wait = util.wait_interval
+                if not hedged and len(started) < len(copies):
+                    wait = max(0.0, min(wait, hedge_at - time.monotonic()))
+                race.answered.wait(wait)
+
+            # the part is written out by the winner's reader as it arrives, the rest are stopped
+            node, connection, request, start = race.winner
+            now = time.monotonic()
+            for attempt in live:
+                if attempt is not race.winner:
+                    NodeStats.record_latency(attempt[0].id, now - attempt[3])
+                    attempt[1].cancel(attempt[2])
+            NodeStats.record_latency(node.id, race.first_at - start)
+            connection.check_response(request, "download")
+            NodeStats.record_throughput(node.id, copies[0][0].size if length is None else length,
+                                        time.monotonic() - race.first_at)
 
         except socket.error as e:
-            rtn_val[index] = str(e)
+            errors[index] = str(e)
 
         finally:
-            node.socket_lock.release()
+            for node, connection, request, start in started:
+                if request is not None:
+                    connection.cancel(request)
+                    # the request's sink leads back to the race and the writer, which would keep the part's
+                    # buffer alive until the cycle collector found it
+                    request.open_sink = request.sink = None
+                if connection is not None:
+                    node.checkin(connection)
+                NodeStats.end(node.id)
+            started.clear()
+            race.writer = None
+            writer.close()
 
     def delete_file(self, id):
         try:
@@ -1373,7 +3459,7 @@ class Master:
                 raise Exception("The requested file does not exist")
 
             # get all the file parts
-            file_parts = [x for x in FilePart.get_file_parts() if x.file_id == file_obj.id]
+            file_parts = FilePart.get_file_parts_by_file(file_obj.id)
             num_parts = len(file_parts)
 
             node_dict = {}  # key: node_id  value: node
@@ -1381,39 +3467,28 @@ class Master:
                 node_dict[node.id] = node
 
             # delete each file part where the node is connected
-            self.busy = True
-            rtn_val = []
-            threads = []
+            jobs = []
             parts = []
-            index = 0
             for part in file_parts:
                 if part.node_id in node_dict:
-                    rtn_val.append(None)
                     parts.append(part)
-                    t = threading.Thread(target=self.delete_part,
-                                         args=(node_dict[part.node_id],
-                                               part.access_name,
-                                               rtn_val,
-                                               index))
-                    threads.append(t)
-                    t.start()
-                else:
-                    FilePart.delete_file_part(part)
-                index += 1
+                    jobs.append((node_dict[part.node_id], part.access_name))
 
-            for t in threads:
-                t.join()
-            self.busy = False
+            if self.engine is not None:
+                rtn_val = self.engine.run(self.engine.delete_parts(jobs))
+            else:
+                rtn_val = [None] * len(jobs)
+                self.foreground.run_all(self.delete_part, [job + (rtn_val, index) for index, job in enumerate(jobs)])
 
             # check for any errors
             for idx, val in enumerate(rtn_val):
-                part = parts[idx]
-                FilePart.delete_file_part(part)
-
                 if isinstance(val, str):
                     print(val)
 
+            # the parts are gone from the database whether or not their nodes could delete them, and the copies
+            # lost with their nodes go with the file
             File.delete_file(file_obj)
+            PartCache.invalidate([part.access_name for part in file_parts])
 
         except Exception as e:
             print(str(e))
@@ -1421,54 +3496,28 @@ class Master:
             return None
 
     def delete_part(self, node, name, errors, index):
-        node.socket_lock.acquire()
         try:
-            # send command
-            node.socket.sendall(util.s_to_bytes("DELETE"))
-            ready = select.select([node.socket], [], [], util.slave_response_timeout)
-            if ready[0]:
-                response = util.s_from_bytes(node.socket.recv(util.bufsize))
-            else:
-                response = "FAIL"
-            if response != "OK":
-                raise socket.error("upload time out")
-            # send the name
-            node.socket.sendall(util.s_to_bytes(name))
-            ready = select.select([node.socket], [], [], util.slave_response_timeout)
-            if ready[0]:
-                response = util.s_from_bytes(node.socket.recv(util.bufsize))
-            else:
-                response = "FAIL"
-            if response != "OK":
-                raise socket.error("upload time out")
+            # send the command and name
+            request = node.connection.new_request()
+            node.connection.send_frame(util.op_delete, request.request_id, util.s_to_bytes(name))
+            node.connection.check_response(request, "delete")
 
         except socket.error as e:
             errors[index] = str(e)
 
-        finally:
-            node.socket_lock.release()
-
     def search_files(self, substr):
         file_ids = set()
         # search each active node for their file parts
-        self.busy = True
-        rtn_val = []
-        threads = []
-        index = 0
-        for node in self.nodes:
-            rtn_val.append(None)
-            t = threading.Thread(target=self.search_file_parts,
-                                 args=(node,
-                                       substr,
-                                       rtn_val,
-                                       index))
-            threads.append(t)
-            t.start()
-            index += 1
-
-        for t in threads:
-            t.join()
-        self.busy = False
+        if self.engine is not None:
+            rtn_val = self.engine.run(self.engine.search_nodes(list(self.nodes), substr))
+            for idx, val in enumerate(rtn_val):
+                if not isinstance(val, str):
+                    rtn_val[idx] = FilePart.get_file_parts_by_names(val)
+        else:
+            nodes = list(self.nodes)
+            rtn_val = [None] * len(nodes)
+            self.foreground.run_all(self.search_file_parts,
+                                    [(node, substr, rtn_val, index) for index, node in enumerate(nodes)])
 
         # check for any errors
         for idx, val in enumerate(rtn_val):
@@ -1485,39 +3534,25 @@ class Master:
         return files
 
     def search_file_parts(self, node, substr, rtn_val, index):
-        node.socket_lock.acquire()
         try:
-            # send command
-            node.socket.sendall(util.s_to_bytes("SEARCH"))
-            ready = select.select([node.socket], [], [], util.slave_response_timeout)
-            if ready[0]:
-                response = util.s_from_bytes(node.socket.recv(util.bufsize))
-            else:
-                response = "FAIL"
-            if response != "OK":
-                raise socket.error("upload time out")
-            # send the name
-            node.socket.sendall(substr)
-            ready = select.select([node.socket], [], [], util.slave_response_timeout)
-            if ready[0]:
-                response = util.s_from_bytes(node.socket.recv(util.bufsize))
-            else:
-                response = "FAIL"
-
-            if response == "NONE":
+            # send the command and search string
+            response = bytearray()
+            request = node.connection.new_request(lambda frame: util.ViewWriter(response))
+            node.connection.send_frame(util.op_search, request.request_id, payload=substr)
+            node.connection.check_response(request, "search")
+            response = util.s_from_bytes(response)
+
+            if response == "":
                 rtn_val[index] = []
             else:
                 names = response.split(",")
-                files = [part for part in FilePart.get_file_parts() if part.access_name in names]
+                files = FilePart.get_file_parts_by_names(names)
 
                 rtn_val[index] = files
 
         except socket.error as e:
             rtn_val[index] = str(e)
 
-        finally:
-            node.socket_lock.release()
-
     def listen_for_commands(self):
         if self.command_thread is None:
             self.command_thread = threading.Thread(target=self.command_loop, daemon=True)
@@ -1552,6 +3587,24 @@ class Master:
                     files = File.get_lost_files()
                     for file in files:
                         print(file.to_string())
+                elif command == "stats":
+                    for name, pool in [("foreground", self.foreground), ("background", self.background)]:
+                        stats = pool.stats()
+                        print(name + ": " + str(stats["active"]) + "/" + str(stats["size"]) + " active, " +
+                              str(stats["queued"]) + " queued, " + str(stats["completed"]) + " completed, " +
+                              str(round(stats["utilization"] * 100, 1)) + "% utilization")
+                    stats = self.repairs.stats()
+                    print("repairs: " + str(stats["active"]) + " active, " + str(stats["queued"]) + " queued, " +
+                          str(stats["parked"]) + " waiting for nodes, " + str(stats["completed"]) + " completed, " +
+                          str(stats["failed"]) + " failed")
+                    stats = PartCache.stats()
+                    print("part cache: " + str(stats["parts"]) + " parts, " + str(stats["size"]) + " bytes, " +
+                          str(stats["spilled"]) + " bytes spilled, " + str(round(stats["hit_ratio"] * 100, 1)) +
+                          "% hits, " + str(stats["evictions"]) + " evictions")
+                    for node_id, (latency, throughput, active) in sorted(NodeStats.stats().items()):
+                        speed = "?" if throughput is None else str(round(throughput / 1048576, 1))
+                        print("node " + str(node_id) + ": " + str(round(latency * 1000, 1)) + " ms to answer, " +
+                              speed + " MiB/s, " + str(active) + " downloads")
                 elif command == "close":
                     self.close()
                     print("Closing master controller")
@@ -1564,10 +3617,8 @@ class Master:
                     file = open(file_path, mode='rb')
                     name = file.name.replace("\\", "/")
                     name = name.split("/")[-1]
-                    f = file.read()
-                    bytes = bytearray(f)
+                    self.upload_stream(name, file)
                     file.close()
-                    self.upload_file(name, bytes)
                     print("File uploaded")
 
                 elif command == "download":
@@ -1575,12 +3626,8 @@ class Master:
                     client_socket.sendall(util.s_to_bytes("OK"))
                     file_id = int(util.s_from_bytes(client_socket.recv(util.bufsize)))
 
-                    bytes = self.download_file(file_id)
                     file_obj = File.get_file(file_id)
-
-                    file = open(file_obj.name, mode='wb')
-                    file.write(bytes)
-                    file.close()
+                    self.download_file_to(file_id, file_obj.name)
 
                     print("File downloaded")
 
@@ -1617,8 +3664,7 @@ class Master:
         return sum([x.storage_space for x in self.nodes])
 
     def get_node_space_available(self, node):
-        file_part_sizes = [part.size for part in FilePart.get_file_parts() if part.node_id == node.id]
-        return node.storage_space - sum(file_part_sizes)
+        return SpaceLedger.get_available(node)
 
     def get_total_space_available(self):
         return sum([self.get_node_space_available(x) for x in self.nodes])
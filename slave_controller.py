@@ -1,6 +1,8 @@
 import os
 import sys
+import mmap
 import socket
+import threading
 import time
 if __name__ == "__main__":
     import util
@@ -8,6 +10,327 @@ else:
     from . import util
 
 
+class PartUpload:
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.error = None
+        self.forward = None  # socket to the next slave in the chain, when the part is passed along
+
+
+class SlaveConnection:
+    """
+    One connection to the master, either the control connection or one of the data connections. Each runs its own
+    loop reading requests and keeps track of the transfers going over it. Connections from other slaves sending
+    copies of parts are served the same way, but they are given authorize and can only upload parts the master
+    has granted them
+    """
+    def __init__(self, sock, storage_loc, authorize=None):
+        self.socket = sock
+        self.storage_loc = storage_loc
+        self.authorize = authorize  # set on connections from other slaves, checks the grant sent with an upload
+        self.uploads = {}  # key: request_id  value: PartUpload still being received
+        self.active = set()  # request_ids of downloads and copies being sent, from when they arrive
+        self.cancelled = set()  # request_ids of downloads the master gave up on
+
+        # locks
+        self.send_lock = threading.Lock()
+
+    def send_frame(self, opcode, request_id, meta=b"", payload=b"", status=util.status_ok, flags=0):
+        util.send_frame(self.socket, opcode, request_id, meta, payload, status, flags, lock=self.send_lock)
+
+    def begin_upload(self, frame):
+        # the meta is the name, then for a chain upload the host, peer port and grant of each slave to pass it to
+        fields = util.s_from_bytes(frame.meta).split(" ")
+        name = fields[0]
+        chain = fields[1:]
+        error = None
+        if self.authorize is not None:
+            # copies from other slaves carry the master's grant after the name
+            grant = chain[0] if len(chain) > 0 else ""
+            chain = chain[1:]
+            if not self.authorize(name, grant):
+                error = "copy not authorized"
+
+        upload = PartUpload(self.storage_loc + '/' + name)
+        upload.error = error
+        if upload.error is None:
+            try:
+                upload.file = open(upload.path, mode='wb')
+            except OSError as e:
+                upload.error = str(e)
+
+        if upload.error is None and len(chain) >= 3:
+            # pass the part along to the next slave as it comes in, along with the rest of the chain
+            try:
+                upload.forward = socket.create_connection((chain[0], int(chain[1])), util.slave_connect_timeout)
+                util.tune_socket(upload.forward)
+                util.send_frame(upload.forward, util.op_upload, frame.request_id,
+                                util.s_to_bytes(" ".join([name] + chain[2:])), flags=util.flag_more)
+            except OSError as e:
+                upload.error = "passing the part along failed: " + str(e)
+
+        self.uploads[frame.request_id] = upload
+        self.continue_upload(frame)
+
+    def continue_upload(self, frame):
+        upload = self.uploads.get(frame.request_id)
+        if upload is None:
+            # not a transfer we know about, skip over it
+            for chunk in util.recv_chunks(self.socket, frame.payload_len):
+                pass
+            return
+
+        # write the file as it is received, the rest of the message still has to be read if writing fails
+        for chunk in util.recv_chunks(self.socket, frame.payload_len):
+            if upload.error is None:
+                try:
+                    upload.file.write(chunk)
+                except OSError as e:
+                    upload.error = str(e)
+            if upload.error is None and upload.forward is not None:
+                try:
+                    util.send_frame(upload.forward, util.op_data, frame.request_id, payload=chunk,
+                                    flags=util.flag_more)
+                except OSError as e:
+                    upload.error = "passing the part along failed: " + str(e)
+        if frame.status != util.status_ok:
+            upload.error = "upload aborted by the master"
+
+        if not frame.flags & util.flag_more:
+            del self.uploads[frame.request_id]
+            self.finish_upload(upload, frame.request_id)
+
+    def finish_upload(self, upload, request_id):
+        if upload.forward is not None:
+            # the part is only uploaded once the rest of the chain has it too
+            try:
+                if upload.error is None:
+                    util.send_frame(upload.forward, util.op_data, request_id)
+                    answer = util.recv_frame(upload.forward)
+                    if answer.status != util.status_ok:
+                        upload.error = "passing the part along failed: " + util.s_from_bytes(answer.meta)
+                else:
+                    util.send_frame(upload.forward, util.op_data, request_id, status=util.status_fail)
+            except OSError as e:
+                if upload.error is None:
+                    upload.error = "passing the part along failed: " + str(e)
+            # let the next slave know the connection is done with, so it doesn't take the close for a failure
+            try:
+                util.send_frame(upload.forward, util.op_close)
+            except OSError:
+                pass
+            upload.forward.close()
+
+        if upload.file is not None:
+            upload.file.close()
+            if upload.error is not None:
+                os.remove(upload.path)
+
+        if upload.error is None:
+            self.send_frame(util.op_upload, request_id)
+            print("File uploaded")
+        else:
+            self.send_frame(util.op_upload, request_id, util.s_to_bytes(upload.error), status=util.status_fail)
+            print(upload.error)
+
+    def cancel(self, frame):
+        # only downloads still being sent can be cancelled
+        if frame.request_id in self.active:
+            self.cancelled.add(frame.request_id)
+
+    def delete_file(self, frame):
+        file_name = util.s_from_bytes(frame.meta)
+
+        try:
+            os.remove(self.storage_loc + '/' + file_name)
+
+            self.send_frame(util.op_delete, frame.request_id)
+
+            print("File deleted")
+
+        except OSError as e:
+            self.send_frame(util.op_delete, frame.request_id, util.s_to_bytes(str(e)), status=util.status_fail)
+            print(str(e))
+
+    def download_file(self, frame):
+        # the meta is the name, optionally followed by the offset and length of the range of the part to send
+        fields = util.s_from_bytes(frame.meta).split(" ")
+        file_name = fields[0]
+
+        try:
+            file = open(self.storage_loc + '/' + file_name, mode='rb')
+        except OSError as e:
+            self.send_frame(util.op_download, frame.request_id, util.s_to_bytes(str(e)), status=util.status_fail)
+            print(str(e))
+            return
+
+        file_size = os.fstat(file.fileno()).st_size
+        offset = 0
+        count = file_size
+        if len(fields) == 3:
+            offset = int(fields[1]) if fields[1].isdigit() else -1
+            count = int(fields[2]) if fields[2].isdigit() else -1
+            if offset < 0 or count < 0 or offset + count > file_size:
+                file.close()
+                self.send_frame(util.op_download, frame.request_id, util.s_to_bytes("range out of bounds"),
+                                status=util.status_fail)
+                return
+
+        # the part goes from disk to the socket without being copied into memory, a frame at a time so other
+        # responses can be sent in between
+        try:
+            util.send_file_message(self.socket, util.op_download, frame.request_id, util.s_to_bytes(str(count)),
+                                   file, offset, count, lock=self.send_lock,
+                                   cancelled=lambda: frame.request_id in self.cancelled)
+        finally:
+            file.close()
+
+        print("File downloaded")
+
+    def replicate_file(self, frame):
+        """
+        Sends a copy of a part straight to another slave. The meta is the part's name, the other slave's host and
+        peer port, and the grant from the master it has to be shown
+        :param frame:
+        :return:
+        """
+        started = False
+        try:
+            fields = util.s_from_bytes(frame.meta).split(" ")
+            if len(fields) != 4 or not fields[2].isdigit():
+                raise ValueError("invalid replicate request")
+            file_name, host, port, grant = fields
+
+            file = open(self.storage_loc + '/' + file_name, mode='rb')
+            try:
+                file_size = os.fstat(file.fileno()).st_size
+                peer = socket.create_connection((host, int(port)), util.slave_connect_timeout)
+                try:
+                    util.tune_socket(peer)
+                    self.send_frame(util.op_replicate, frame.request_id, util.s_to_bytes(str(file_size)),
+                                    flags=util.flag_more)
+                    started = True
+
+                    def cancelled():
+                        # the master hears from us before each frame goes to the other slave, so it knows the copy
+                        # is still going
+                        self.send_frame(util.op_data, frame.request_id, flags=util.flag_more)
+                        return frame.request_id in self.cancelled
+
+                    util.send_file_message(peer, util.op_upload, frame.request_id,
+                                           util.s_to_bytes(file_name + " " + grant), file, 0, file_size,
+                                           cancelled=cancelled)
+                    answer = util.recv_frame(peer)
+                    if answer.status != util.status_ok:
+                        raise util.ProtocolError("copy refused: " + util.s_from_bytes(answer.meta))
+                finally:
+                    try:
+                        util.send_frame(peer, util.op_close)
+                    except OSError:
+                        pass
+                    peer.close()
+            finally:
+                file.close()
+
+            self.send_frame(util.op_data, frame.request_id)
+            print("File replicated")
+
+        except Exception as e:
+            # any failure is answered, so the master doesn't have to wait for the copy to time out
+            if started:
+                self.send_frame(util.op_data, frame.request_id, util.s_to_bytes(str(e)), status=util.status_fail)
+            else:
+                self.send_frame(util.op_replicate, frame.request_id, util.s_to_bytes(str(e)),
+                                status=util.status_fail)
+            print(str(e))
+
+    def file_contains_substring(self, path, substr):
+        try:
+            file = open(self.storage_loc + '/' + path, mode='rb')
+            if os.fstat(file.fileno()).st_size == 0:
+                file.close()
+                return False
+
+            # search a memory map of the file rather than reading all of it in
+            file_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            found = file_map.find(substr) != -1
+            file_map.close()
+            file.close()
+
+            return found
+
+        except Exception as e:
+            return False
+
+    def search_files(self, frame):
+        search_string = bytes(frame.payload)  # search as bytes because the files are read as bytes
+
+        files = os.listdir(self.storage_loc)
+
+        matching = [file for file in files if (self.file_contains_substring(file, search_string))]
+
+        self.send_frame(util.op_search, frame.request_id, payload=util.s_to_bytes(','.join(matching)))
+
+    def handle_request(self, handler, frame):
+        try:
+            handler(frame)
+        except socket.error as e:
+            # the connection is gone, the main loop will notice and start over
+            print(str(e))
+        finally:
+            self.active.discard(frame.request_id)
+            self.cancelled.discard(frame.request_id)
+
+    def serve(self):
+        while True:
+            frame = util.recv_frame_header(self.socket)
+
+            if self.authorize is not None and frame.opcode not in (util.op_upload, util.op_data, util.op_close):
+                # other slaves can only send copies
+                self.refuse(frame)
+            elif frame.opcode == util.op_open:
+                self.send_frame(util.op_open, frame.request_id)
+            elif frame.opcode == util.op_close:
+                print("Close command received")
+                break
+            elif frame.opcode == util.op_upload:
+                self.begin_upload(frame)
+            elif frame.opcode == util.op_data:
+                self.continue_upload(frame)
+            elif frame.opcode == util.op_cancel:
+                self.cancel(frame)
+            elif frame.opcode in (util.op_download, util.op_delete, util.op_search, util.op_replicate):
+                # answer in the background so the requests behind this one aren't held up. The request can be
+                # cancelled from here on, even before its handler gets going
+                frame.payload = util.recv_exact(self.socket, frame.payload_len)
+                if frame.opcode in (util.op_download, util.op_replicate):
+                    self.active.add(frame.request_id)
+                handlers = {util.op_download: self.download_file,
+                            util.op_delete: self.delete_file,
+                            util.op_search: self.search_files,
+                            util.op_replicate: self.replicate_file}
+                t = threading.Thread(target=self.handle_request, args=(handlers[frame.opcode], frame), daemon=True)
+                t.start()
+            else:
+                self.refuse(frame)
+
+    def refuse(self, frame):
+        # skip over whatever was sent with it
+        for chunk in util.recv_chunks(self.socket, frame.payload_len):
+            pass
+        self.send_frame(frame.opcode, frame.request_id, util.s_to_bytes("unrecognized command"),
+                        status=util.status_fail)
+        print("unrecognized command")
+
+    def close(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.socket.close()
+
+
 class Slave:
     def __init__(self, address=None, port=None, storage_space=None, storage_loc=None):
         # member variables
@@ -17,6 +340,14 @@ class Slave:
         self.port = 0
         self.storage_space = 0
         self.storage_loc = ""
+        self.token = ""
+        self.control = None
+        self.data_connections = []
+        self.peer_socket = None
+        self.used_grants = set()  # nonces of the grants other slaves have already used this session
+
+        # locks
+        self.grant_lock = threading.Lock()
 
         # if all params are None then read from a config file
         if address is None and port is None and storage_space is None and storage_loc is None:
@@ -32,21 +363,64 @@ class Slave:
         # continually try and create the connection until successful
         while True:
             try:
-                self.socket = socket.create_connection((self.address, self.port), util.slave_connect_timeout)
-                self.socket.settimeout(None)
+                self.socket = self.open_socket()
                 break
             except socket.error as e:
                 print(str(e))
                 time.sleep(util.slave_connect_wait)
         print("Connection established")
 
-        # initial connection protocol
-        self.socket.sendall(util.i_to_bytes(self.id))
-        self.id = util.i_from_bytes(self.socket.recv(util.bufsize))
-        self.socket.sendall(util.i_to_bytes(self.storage_space))
+        try:
+            # other slaves send copies of parts to us here, the master is told the port with the hello
+            self.peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.peer_socket.bind(("", util.peer_port))
+            self.peer_socket.listen(5)
+
+            # initial connection protocol, the master answers with our id and a token for the data connections
+            util.send_frame(self.socket, util.op_hello,
+                            meta=util.s_to_bytes(str(self.id) + " " + str(self.storage_space) + " " +
+                                                 str(self.peer_socket.getsockname()[1])))
+            frame = util.recv_frame(self.socket)
+            if frame.opcode != util.op_hello:
+                raise util.ProtocolError("unexpected handshake response")
+            hello = util.s_from_bytes(frame.meta).split(" ")
+            self.id = int(hello[0])
+            self.token = hello[1]
+        except BaseException:
+            # let go of the sockets so the next attempt can bind the same peer port
+            self.peer_socket.close()
+            self.socket.close()
+            raise
 
         self.write_config_settings()
 
+        self.control = SlaveConnection(self.socket, self.storage_loc)
+
+        # open the data connections which the master sends file parts over
+        for i in range(util.data_connections):
+            try:
+                self.data_connections.append(SlaveConnection(self.attach_socket(), self.storage_loc))
+            except socket.error as e:
+                print("Data connection failed: " + str(e))
+
+    def open_socket(self):
+        sock = socket.create_connection((self.address, self.port), util.slave_connect_timeout)
+        sock.settimeout(None)
+        util.tune_socket(sock)
+
+        return sock
+
+    def attach_socket(self):
+        # open a new connection and prove to the master that it belongs to this node
+        sock = self.open_socket()
+        util.send_frame(sock, util.op_attach, meta=util.s_to_bytes(str(self.id) + " " + self.token))
+        frame = util.recv_frame(sock)
+        if frame.opcode != util.op_attach or frame.status != util.status_ok:
+            sock.close()
+            raise util.ProtocolError("data connection refused")
+
+        return sock
+
     def read_config_settings(self):
         if not os.path.isfile(util.config_file):
             raise FileExistsError()
@@ -71,114 +445,51 @@ class Slave:
 
         file.close()
 
-    def upload_file(self):
-        file_name = util.s_from_bytes(self.socket.recv(util.bufsize))
-        self.socket.sendall(util.s_to_bytes("OK"))
-        file_size = util.i_from_bytes(self.socket.recv(util.bufsize))
-        self.socket.sendall(util.s_to_bytes("OK"))
-
-        # get the file in "chunks" of bufsize
-        bytes = bytearray()
-        num_got = 0
-        while num_got < file_size:
-            chunk = self.socket.recv(util.bufsize)
-            bytes += chunk
-            num_got += len(chunk)
-
-        self.socket.sendall(util.s_to_bytes("OK"))
-
-        # write the file
-        file = open(self.storage_loc + '/' + file_name, mode='wb')
-        file.write(bytes)
-        file.close()
-
-        print("File uploaded")
-
-    def delete_file(self):
-        file_name = util.s_from_bytes(self.socket.recv(util.bufsize))
-
-        os.remove(self.storage_loc + '/' + file_name)
-
-        self.socket.sendall(util.s_to_bytes("OK"))
-
-        print("File deleted")
-
-    def download_file(self):
-        file_name = util.s_from_bytes(self.socket.recv(util.bufsize))
-
-        try:
-            file = open(self.storage_loc + '/' + file_name, mode='rb')
-            f = file.read()
-            bytes = bytearray(f)
-
-            self.socket.sendall(util.i_to_bytes(len(bytes)))
-
-            response = util.s_from_bytes(self.socket.recv(util.bufsize))
-            if response != "SEND":
-                raise Exception("Unrecognized command")
-
-            self.socket.sendall(bytes)
-
-            file.close()
-
-            print("File downloaded")
-
-        except FileNotFoundError as e:
-            self.socket.sendall(util.s_to_bytes("FAIL"))
-            print(str(e))
+    def start(self):
+        for connection in self.data_connections:
+            t = threading.Thread(target=self.serve_data, args=(connection,), daemon=True)
+            t.start()
+        t = threading.Thread(target=self.serve_peers, daemon=True)
+        t.start()
 
-    def file_contains_substring(self, path, substr):
         try:
-            file = open(self.storage_loc + '/' + path, mode='rb')
-            f = file.read()
-
-            if f.find(substr) != -1:
-                return True
-            else:
-                return False
-
-        except Exception as e:
-            return False
-
-    def search_files(self):
-        search_string = self.socket.recv(util.bufsize)  # we want to use bytes because the file will be read as bytes
-
-        files = os.listdir(self.storage_loc)
-
-        matching = [file for file in files if (self.file_contains_substring(file, search_string))]
-
-        if len(matching) > 0:
-            self.socket.sendall(util.s_to_bytes(','.join(matching)))
-        else:
-            self.socket.sendall(util.s_to_bytes("NONE"))
-
-    def start(self):
+            self.control.serve()
+        finally:
+            # the data connections go when the control connection does
+            for connection in self.data_connections:
+                connection.close()
+            self.control.close()
+            self.peer_socket.close()
+
+    def serve_peers(self):
         while True:
-            command = util.s_from_bytes(self.socket.recv(util.bufsize))
+            try:
+                (sock, address) = self.peer_socket.accept()
+            except socket.error:
+                # closed along with the control connection
+                return
+
+            util.tune_socket(sock)
+            connection = SlaveConnection(sock, self.storage_loc, authorize=self.authorize_copy)
+            t = threading.Thread(target=self.serve_data, args=(connection,), daemon=True)
+            t.start()
+
+    def authorize_copy(self, name, grant):
+        # a grant is only good for the part it was made for, and only once
+        nonce = util.check_grant(self.token, name, grant)
+        with self.grant_lock:
+            if nonce is None or nonce in self.used_grants:
+                return False
+            self.used_grants.add(nonce)
 
-            if command == "OPEN":
-                self.socket.sendall(util.s_to_bytes("OPEN"))
-            elif command == "CLOSE":
-                print("Close command received")
-                break
-            elif command == "UPLOAD":
-                self.socket.sendall(util.s_to_bytes("OK"))
-                self.upload_file()
-            elif command == "DOWNLOAD":
-                self.socket.sendall(util.s_to_bytes("OK"))
-                self.download_file()
-            elif command == "DELETE":
-                self.socket.sendall(util.s_to_bytes("OK"))
-                self.delete_file()
-            elif command == "SEARCH":
-                self.socket.sendall(util.s_to_bytes("OK"))
-                self.search_files()
-            else:
-                self.socket.sendall(util.s_to_bytes("UNKNOWN"))
-                print("unrecognized command")
+        return True
 
-        # close the open socket
-        self.socket.close()
+    def serve_data(self, connection):
+        try:
+            connection.serve()
+        except (socket.error, ValueError) as e:
+            print("Data connection closed: " + str(e))
+        connection.close()
 
 
 def main(args):
@@ -1,10 +1,36 @@
+import os
+import hmac
+import mmap
+import stat
+import time
+import queue
+import secrets
+import socket
+import struct
+import threading
 import datetime
+import concurrent.futures
 
 
 # GLOBAL settings
 database = "database.db"
+database_cache_size = 16384  # KiB of pages each database connection keeps in memory
+database_mmap_size = 268435456
+database_cached_statements = 256
+metadata_cache_size = 1000000  # file and file part rows the master keeps in memory
+part_cache_size = 268435456  # bytes of downloaded parts the master keeps in memory, 0 turns the part cache off
+part_cache_spill = ""  # directory parts dropped from the part cache are kept in, "" throws them away
+part_cache_spill_size = 4294967296  # bytes of parts kept in the spill directory
 config_file = "config.dsa"
 bufsize = 1024
+transfer_bufsize = 1048576
+socket_bufsize = 4194304
+buffer_pool_size = 16
+stream_window = 8
+stream_stall_timeout = 0.5  # seconds a streamed download waits for its consumer to make room before it's dropped,
+                            # kept below slave_response_timeout so other requests on the connection don't time out
+readahead_size = 4194304  # bytes of a file a FileReader downloads at a time
+readahead_window = 4  # ranges a FileReader keeps downloading ahead of the one being read
 restart_window = 10.0
 wait_interval = .1
 command_port = 18981
@@ -14,6 +40,44 @@ master_continuous_wait = 3.0
 slave_response_timeout = 1.0
 slave_reconnect_window = 10.0
 redundant_level = 2
+write_quorum = 0  # copies of each part written before an upload returns, the rest finish in the background, 0 is all
+data_connections = 4
+foreground_workers = 32  # threads for the master's client requests
+background_workers = 8  # threads for heartbeats and recovery, 0 shares the foreground workers
+repair_workers = 4  # threads copying parts back up to the redundancy level after a node is lost
+repair_node_streams = 2  # repair transfers reading from or writing to any one node at a time
+master_engine = "threads"  # "threads" or "asyncio", which runs uploads, downloads, deletes and searches as
+                           # coroutines, see AsyncEngine for what stays on threads
+peer_port = 0  # port the slaves take copies of parts from each other on, 0 picks any free port
+peer_replication = True  # repairs copy parts straight from one slave to another instead of through the master
+upload_mode = "fanout"  # "fanout" sends every copy of a part from the master, "chain" sends it once and the slaves
+                        # pass it along to the rest of its nodes
+node_stats_weight = 0.2  # weight of the newest sample in the moving averages of each node's download speed
+hedge_percentile = 0.95  # a download slower to start than this share of recent ones is asked of another copy too,
+                         # 0 turns hedging off
+hedge_min_delay = 0.005  # seconds a download is always given before another copy is asked
+stripe_size = 4194304  # parts at least twice this big are read in pieces from all of their copies at once,
+                       # 0 reads each part from one copy
+
+# PROTOCOL settings
+protocol_version = 1
+# version, opcode, flags, status, request_id, meta_len, payload_len
+frame_header = struct.Struct("<BBBBIIQ")
+max_meta_len = 65536
+op_hello = 1
+op_open = 2
+op_close = 3
+op_upload = 4
+op_download = 5
+op_delete = 6
+op_search = 7
+op_data = 8
+op_cancel = 9
+op_attach = 10
+op_replicate = 11
+status_ok = 0
+status_fail = 1
+flag_more = 1
 
 
 def i_from_bytes(val):
@@ -68,3 +132,635 @@ def datetime_to_s(val):
     :return:
     """
     return val.strftime(format="%m %d %Y %H:%M:%S.%f")
+
+
+def make_grant(token, name):
+    """
+    Returns a grant which lets whoever holds it send the part with the given name to the slave whose session token
+    is token, once. The master hands these out for copies going straight from one slave to another
+    :param token:
+    :param name:
+    :return:
+    """
+    nonce = secrets.token_hex(8)
+    return nonce + ":" + hmac.new(s_to_bytes(token), s_to_bytes(name + " " + nonce), "sha256").hexdigest()
+
+
+def check_grant(token, name, grant):
+    """
+    Returns the nonce of the grant if it was made by make_grant for the same token and name, otherwise None
+    :param token:
+    :param name:
+    :param grant:
+    :return:
+    """
+    nonce, _, digest = grant.partition(":")
+    expected = hmac.new(s_to_bytes(token), s_to_bytes(name + " " + nonce), "sha256").hexdigest()
+    if len(nonce) == 0 or not hmac.compare_digest(expected, digest):
+        return None
+
+    return nonce
+
+
+class ChunkReader:
+    """
+    Wraps either a file-like object or an iterator of byte chunks so either can be read from in
+    pieces of a given size
+    """
+    def __init__(self, source):
+        self.read_func = None
+        self.chunks = None
+        self.pending = memoryview(b"")
+
+        if hasattr(source, "read"):
+            self.read_func = source.read
+        else:
+            self.chunks = iter(source)
+
+    def read(self, size):
+        if self.read_func is not None:
+            return self.read_func(size)
+
+        while len(self.pending) == 0:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return b""
+            self.pending = memoryview(chunk)
+
+        data = self.pending[:size]
+        self.pending = self.pending[size:]
+        return data
+
+
+def read_chunks(reader, length):
+    """
+    Reads exactly length bytes from the given reader, yielding them in chunks of at most transfer_bufsize
+    :param reader:
+    :param length:
+    :return:
+    """
+    remaining = length
+    while remaining > 0:
+        chunk = reader.read(min(remaining, transfer_bufsize))
+        if len(chunk) == 0:
+            raise EOFError("stream ended " + str(remaining) + " bytes early")
+        remaining -= len(chunk)
+        yield chunk
+
+
+def pread_chunks(fd, offset, length):
+    """
+    Reads length bytes starting at offset from the given file descriptor, yielding them in chunks of at most
+    transfer_bufsize. The file position is never used so several of these can run over the same descriptor at once
+    :param fd:
+    :param offset:
+    :param length:
+    :return:
+    """
+    end = offset + length
+    while offset < end:
+        chunk = os.pread(fd, min(end - offset, transfer_bufsize), offset)
+        if len(chunk) == 0:
+            raise EOFError("file ended " + str(end - offset) + " bytes early")
+        offset += len(chunk)
+        yield chunk
+
+
+free_buffers = []
+free_buffers_lock = threading.Lock()
+
+
+def take_buffer():
+    """
+    Returns a transfer_bufsize bytearray from the pool of free buffers, allocating a new one if none are free
+    :return:
+    """
+    with free_buffers_lock:
+        if len(free_buffers) > 0:
+            return free_buffers.pop()
+    return bytearray(transfer_bufsize)
+
+
+def give_buffer(buffer):
+    """
+    Returns a buffer given out by take_buffer to the pool so it can be used again
+    :param buffer:
+    :return:
+    """
+    with free_buffers_lock:
+        if len(free_buffers) < buffer_pool_size and len(buffer) == transfer_bufsize:
+            free_buffers.append(buffer)
+
+
+def tune_socket(sock):
+    """
+    Sets the options used on every connection between the master and the slaves
+    :param sock:
+    :return:
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, socket_bufsize)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, socket_bufsize)
+
+
+def recv_exact(sock, size):
+    """
+    Receives exactly size bytes from the given socket into a single preallocated bytearray and returns it
+    :param sock:
+    :param size:
+    :return:
+    """
+    data = bytearray(size)
+    view = memoryview(data)
+    num_got = 0
+    while num_got < size:
+        got = sock.recv_into(view[num_got:])
+        if got == 0:
+            raise ConnectionError("connection closed with " + str(size - num_got) + " bytes left to receive")
+        num_got += got
+    view.release()
+
+    return data
+
+
+def recv_chunks(sock, size):
+    """
+    Receives exactly size bytes from the given socket, yielding them in chunks of at most transfer_bufsize. The
+    chunks are views into a reused buffer, so each one is only valid until the next is yielded
+    :param sock:
+    :param size:
+    :return:
+    """
+    buffer = take_buffer()
+    view = memoryview(buffer)
+    try:
+        remaining = size
+        while remaining > 0:
+            got = sock.recv_into(view, min(remaining, transfer_bufsize))
+            if got == 0:
+                raise ConnectionError("connection closed with " + str(remaining) + " bytes left to receive")
+            remaining -= got
+            yield view[:got]
+    finally:
+        view.release()
+        give_buffer(buffer)
+
+
+class QueueWriter:
+    """
+    File-like writer which puts a copy of everything written to it on the given queue, until it is closed. When a
+    timeout is given and the queue stays full that long, the write fails instead of holding up the caller, which is
+    a connection's reader thread
+    """
+    def __init__(self, queue, timeout=None):
+        self.queue = queue
+        self.timeout = timeout
+        self.closed = False
+
+    def write(self, data):
+        if not self.closed:
+            try:
+                self.queue.put(bytes(data), timeout=self.timeout)
+            except queue.Full:
+                raise ProtocolError("the consumer of the download fell behind")
+
+    def close(self):
+        self.closed = True
+
+
+class ViewWriter:
+    """
+    File-like writer which copies everything written to it into the given memoryview (or bytearray, which is
+    grown as needed), starting at offset
+    """
+    def __init__(self, view, offset=0):
+        self.view = view
+        self.pos = offset
+
+    def write(self, data):
+        self.view[self.pos:self.pos + len(data)] = data
+        self.pos += len(data)
+
+    def close(self):
+        pass
+
+
+def download_meta(name, offset=0, length=None):
+    """
+    Returns the meta of a download of the part with the given name. Without a length the whole part is sent,
+    otherwise only length bytes of it starting at offset
+    :param name:
+    :param offset:
+    :param length:
+    :return:
+    """
+    if length is None:
+        return s_to_bytes(name)
+
+    return s_to_bytes(name + " " + str(offset) + " " + str(length))
+
+
+class DownloadRace:
+    """
+    Several copies of one part asked for it at once. The first to start answering claims the writer and the rest
+    are turned away, to be cancelled by whoever started them. answered is a threading.Event or an asyncio.Event,
+    whichever the caller waits on
+    """
+    def __init__(self, writer, answered):
+        self.writer = writer
+        self.answered = answered
+        self.winner = None  # the attempt whose answer is written out
+        self.first_at = None  # when the winner started answering
+        self.lock = threading.Lock()
+
+    def claimer(self, attempt):
+        # returns the open_sink of the request made for the given attempt
+        return lambda frame: self.claim(attempt)
+
+    def claim(self, attempt):
+        with self.lock:
+            if self.winner is not None:
+                raise ValueError("another copy answered first")
+            self.winner = attempt
+            self.first_at = time.monotonic()
+        self.answered.set()
+
+        return self.writer
+
+
+def send_file(sock, file, offset, count):
+    """
+    Sends count bytes of the given open file, starting at offset, over the socket without reading them into
+    memory first. os.sendfile is used where the platform has it, otherwise the file is memory mapped and sent
+    straight from the map
+    :param sock:
+    :param file:
+    :param offset:
+    :param count:
+    :return:
+    """
+    if count == 0:
+        return
+
+    if hasattr(os, "sendfile"):
+        sock.sendfile(file, offset, count)
+    else:
+        file_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(file_map)
+        try:
+            sock.sendall(view[offset:offset + count])
+        finally:
+            view.release()
+            file_map.close()
+
+
+class ProtocolError(ConnectionError):
+    """
+    Raised when a peer sends something that doesn't follow the framing protocol
+    """
+    pass
+
+
+class TransferAborted(ProtocolError):
+    """
+    Raised when the sender of a multi-frame message gives up on it part way through
+    """
+    pass
+
+
+class Frame:
+    def __init__(self):
+        self.opcode = 0
+        self.flags = 0
+        self.status = status_ok
+        self.request_id = 0
+        self.meta = b""
+        self.payload_len = 0
+        self.payload = None
+
+
+def send_frame(sock, opcode, request_id=0, meta=b"", payload=b"", status=status_ok, flags=0, lock=None):
+    """
+    Sends a single frame made up of the header, then meta, then payload. If a lock is given it is held while the
+    frame is sent, so frames from several threads sharing the socket don't get mixed together
+    :param sock:
+    :param opcode:
+    :param request_id:
+    :param meta:
+    :param payload:
+    :param status:
+    :param flags:
+    :param lock:
+    :return:
+    """
+    header = frame_header.pack(protocol_version, opcode, flags, status, request_id, len(meta), len(payload))
+    if lock is not None:
+        lock.acquire()
+    try:
+        # small frames go out in one piece, large payloads are sent on their own so they aren't copied
+        if len(payload) < 65536:
+            sock.sendall(header + meta + payload)
+        else:
+            sock.sendall(header + meta)
+            sock.sendall(payload)
+    finally:
+        if lock is not None:
+            lock.release()
+
+
+def send_message(sock, opcode, request_id, meta, chunks, lock=None):
+    """
+    Sends a message whose payload is made up of the given chunks. The first frame carries the opcode and meta,
+    the payload follows in op_data frames of at most transfer_bufsize, and an empty op_data frame without
+    flag_more ends the message. The lock is only held for one frame at a time, so other messages can be sent in
+    between. If reading the chunks fails, the message is ended with an aborted frame and TransferAborted is raised
+    :param sock:
+    :param opcode:
+    :param request_id:
+    :param meta:
+    :param chunks:
+    :param lock:
+    :return:
+    """
+    send_frame(sock, opcode, request_id, meta, flags=flag_more, lock=lock)
+    chunks = iter(chunks)
+    while True:
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            break
+        except Exception as e:
+            send_frame(sock, op_data, request_id, status=status_fail, lock=lock)
+            raise TransferAborted("reading the message failed: " + str(e)) from e
+
+        view = memoryview(chunk)
+        for pos in range(0, len(view), transfer_bufsize):
+            send_frame(sock, op_data, request_id, payload=view[pos:pos + transfer_bufsize], flags=flag_more, lock=lock)
+    send_frame(sock, op_data, request_id, lock=lock)
+
+
+def send_file_message(sock, opcode, request_id, meta, file, offset, count, lock=None, cancelled=None):
+    """
+    Like send_message, but the payload is count bytes of the given file starting at offset, sent with send_file.
+    cancelled may be a function which is checked before each frame, and if it returns True the message is ended
+    with an aborted frame
+    :param sock:
+    :param opcode:
+    :param request_id:
+    :param meta:
+    :param file:
+    :param offset:
+    :param count:
+    :param lock:
+    :param cancelled:
+    :return:
+    """
+    send_frame(sock, opcode, request_id, meta, flags=flag_more, lock=lock)
+    end = offset + count
+    while offset < end:
+        if cancelled is not None and cancelled():
+            send_frame(sock, op_data, request_id, status=status_fail, lock=lock)
+            return
+
+        length = min(end - offset, transfer_bufsize)
+        if lock is not None:
+            lock.acquire()
+        try:
+            sock.sendall(frame_header.pack(protocol_version, op_data, flag_more, status_ok, request_id, 0, length))
+            send_file(sock, file, offset, length)
+        finally:
+            if lock is not None:
+                lock.release()
+        offset += length
+    send_frame(sock, op_data, request_id, lock=lock)
+
+
+def recv_frame_header(sock):
+    """
+    Receives the header and meta of the next frame. The payload is left on the socket for the caller to read
+    :param sock:
+    :return:
+    """
+    frame, meta_len = unpack_frame_header(recv_exact(sock, frame_header.size))
+    frame.meta = bytes(recv_exact(sock, meta_len))
+
+    return frame
+
+
+def unpack_frame_header(header):
+    """
+    Checks the given frame header and returns the frame it starts along with the length of its meta
+    :param header:
+    :return:
+    """
+    version, opcode, flags, status, request_id, meta_len, payload_len = frame_header.unpack(header)
+    if version != protocol_version:
+        raise ProtocolError("unsupported protocol version " + str(version))
+    if meta_len > max_meta_len:
+        raise ProtocolError("frame meta too long")
+
+    frame = Frame()
+    frame.opcode = opcode
+    frame.flags = flags
+    frame.status = status
+    frame.request_id = request_id
+    frame.payload_len = payload_len
+
+    return frame, meta_len
+
+
+def recv_frame(sock):
+    """
+    Receives the next frame, including its payload
+    :param sock:
+    :return:
+    """
+    frame = recv_frame_header(sock)
+    frame.payload = recv_exact(sock, frame.payload_len)
+
+    return frame
+
+
+def next_message_frame(sock, frame):
+    """
+    Receives the op_data frame following the given one in the same message
+    :param sock:
+    :param frame:
+    :return:
+    """
+    next_frame = recv_frame_header(sock)
+    if next_frame.opcode != op_data or next_frame.request_id != frame.request_id:
+        raise ProtocolError("expected the rest of message " + str(frame.request_id))
+    if next_frame.status != status_ok:
+        raise TransferAborted("message " + str(frame.request_id) + " was aborted by the sender")
+
+    return next_frame
+
+
+def recv_message(sock, frame):
+    """
+    Yields the payload of the message started by the given frame, a chunk at a time. The chunks are views into a
+    reused buffer, so each one is only valid until the next is yielded
+    :param sock:
+    :param frame:
+    :return:
+    """
+    while True:
+        for chunk in recv_chunks(sock, frame.payload_len):
+            yield chunk
+        if not frame.flags & flag_more:
+            break
+        frame = next_message_frame(sock, frame)
+
+
+def recv_message_into(sock, frame, view):
+    """
+    Receives the payload of the message started by the given frame straight into the given memoryview and returns
+    the number of bytes received
+    :param sock:
+    :param frame:
+    :param view:
+    :return:
+    """
+    num_got = 0
+    while True:
+        if num_got + frame.payload_len > len(view):
+            raise ProtocolError("message larger than expected")
+        end = num_got + frame.payload_len
+        while num_got < end:
+            got = sock.recv_into(view[num_got:end])
+            if got == 0:
+                raise ConnectionError("connection closed with " + str(end - num_got) + " bytes left to receive")
+            num_got += got
+        if not frame.flags & flag_more:
+            break
+        frame = next_message_frame(sock, frame)
+
+    return num_got
+
+
+def stream_fileno(stream):
+    """
+    Returns the file descriptor of the given stream if it is a regular file which can be read at random offsets,
+    otherwise None
+    :param stream:
+    :return:
+    """
+    if not hasattr(os, "pread") or not hasattr(stream, "fileno"):
+        return None
+    try:
+        fd = stream.fileno()
+        if not stat.S_ISREG(os.fstat(fd).st_mode):
+            return None
+        return fd
+    except (OSError, ValueError):
+        return None
+
+
+def stream_size(stream):
+    """
+    Returns the number of bytes left to read in the given stream
+    :param stream:
+    :return:
+    """
+    try:
+        fd = stream.fileno()
+        if stat.S_ISREG(os.fstat(fd).st_mode):
+            return os.fstat(fd).st_size - stream.tell()
+    except (AttributeError, OSError, ValueError):
+        pass
+
+    raise ValueError("The size must be given for streams of unknown length")
+
+
+class WorkerPool:
+    """
+    A fixed set of worker threads which jobs are queued to, so fan-outs don't create a thread per job and the number
+    running at once is capped. A job submitted from one of the pool's own workers is run straight away in that
+    worker, so a job which waits on jobs it submitted can't deadlock a full pool
+    """
+    def __init__(self, size, name="worker"):
+        self.size = size
+        self.jobs = queue.Queue()
+        self.workers = set()
+        self.running = {}  # key: worker  value: when the job it's running started
+        self.completed = 0
+        self.busy_time = 0.0
+        self.started = time.monotonic()
+
+        # locks
+        self.stats_lock = threading.Lock()
+
+        for i in range(size):
+            t = threading.Thread(target=self.work, name=name + "-" + str(i), daemon=True)
+            self.workers.add(t)
+            t.start()
+
+    def submit(self, function, *args):
+        """
+        Queues function(*args) to be run by a worker and returns a Future for its result
+        :param function:
+        :param args:
+        :return:
+        """
+        future = concurrent.futures.Future()
+        if threading.current_thread() in self.workers:
+            self.run_job(future, function, args)
+        else:
+            self.jobs.put((future, function, args))
+
+        return future
+
+    def run_all(self, function, jobs):
+        """
+        Runs function(*args) for each args in jobs and waits for all of them to finish. If any of them raised, the
+        first of the errors is raised once they're done
+        :param function:
+        :param jobs:
+        :return:
+        """
+        futures = [self.submit(function, *args) for args in jobs]
+        concurrent.futures.wait(futures)
+
+        return [future.result() for future in futures]
+
+    def stats(self):
+        """
+        Returns the number of workers, the jobs running and waiting, the jobs completed, and the fraction of the
+        workers' time spent running jobs since the pool was made
+        :return:
+        """
+        now = time.monotonic()
+        with self.stats_lock:
+            busy_time = self.busy_time + sum([now - start for start in self.running.values()])
+            stats = {"size": self.size,
+                     "active": len(self.running),
+                     "queued": self.jobs.qsize(),
+                     "completed": self.completed,
+                     "utilization": busy_time / max(self.size * (now - self.started), 1e-9)}
+
+        return stats
+
+    def work(self):
+        worker = threading.current_thread()
+        while True:
+            future, function, args = self.jobs.get()
+
+            with self.stats_lock:
+                self.running[worker] = time.monotonic()
+            self.run_job(future, function, args)
+            with self.stats_lock:
+                self.busy_time += time.monotonic() - self.running.pop(worker)
+                self.completed += 1
+
+            # an idle worker mustn't keep its last job's arguments, and the buffers they lead to, alive
+            del future, function, args
+
+    @staticmethod
+    def run_job(future, function, args):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(function(*args))
+        except BaseException as e:
+            future.set_exception(e)